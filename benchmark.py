@@ -0,0 +1,909 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+性能测试脚本, 不会访问外网, 也不会使用config.py中配置的数据库文件
+用法:
+    python3 benchmark.py db [-n 5000] [--readers 4]
+    python3 benchmark.py checkers [-n 700] [--latency 0.02] [--size 32] [--threads 8] [--cycles 2] [--no-etag]
+    python3 benchmark.py h5ai [--size 1024] [--repeat 5]
+    python3 benchmark.py verify [--size 64] [--drops 3] [--manifest-lines 20000]
+    python3 benchmark.py cassette
+    python3 benchmark.py startup [--repeat 5]
+"""
+
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+def _print_result(title, count, seconds, unit="rows"):
+    print("%-36s %8d %s in %7.3fs  (%10.1f %s/s)" % (title, count, unit, seconds, count / seconds, unit))
+
+def _make_saved_rows(count, version=1):
+    return [
+        {
+            "ID": "Item%05d" % i,
+            "FULL_NAME": "Benchmark item %d" % i,
+            "LATEST_VERSION": "v%d.%d" % (version, i),
+            "BUILD_TYPE": None,
+            "BUILD_VERSION": None,
+            "BUILD_DATE": "2020-01-01",
+            "BUILD_CHANGELOG": None,
+            "FILE_MD5": "%032x" % i,
+            "FILE_SHA1": None,
+            "FILE_SHA256": None,
+            "DOWNLOAD_LINK": "https://example.com/Item%05d.zip" % i,
+            "FILE_SIZE": "1.0 GB",
+        }
+        for i in range(count)
+    ]
+
+def bench_db(count, readers):
+    """
+    对比逐行提交(旧的write_to_database的写法)与DBWriter批量写入Saved数据的吞吐量,
+    并在批量写入的同时用多个线程读取, 观察读操作是否被写操作阻塞
+    """
+    from sqlalchemy.orm import sessionmaker
+    from database import create_db_engine, DBWriter, Saved
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = create_db_engine(os.path.join(tmp_dir, "benchmark.db"))
+        Saved.metadata.create_all(engine)
+        session_factory = sessionmaker(bind=engine)
+        writer = DBWriter(session_factory)
+
+        # 1. 逐行提交, 每次都查询全部ID(旧的write_to_database的写法), 数量较多时非常慢, 因此限制行数
+        legacy_rows = _make_saved_rows(min(count, 1000), version=0)
+        start = time.perf_counter()
+        for row in legacy_rows:
+            session = session_factory()
+            try:
+                if row["ID"] in {x.ID for x in session.query(Saved).all()}:
+                    saved_data = session.query(Saved).filter(Saved.ID == row["ID"]).one()
+                    for key, value in row.items():
+                        setattr(saved_data, key, value)
+                else:
+                    session.add(Saved(**row))
+                session.commit()
+            finally:
+                session.close()
+        _print_result("Per-row commit (legacy)", len(legacy_rows), time.perf_counter() - start)
+
+        # 2. 每行一个写操作提交到DBWriter, 积压的写操作会被合并到同一个事务中
+        rows = _make_saved_rows(count, version=1)
+        start = time.perf_counter()
+        futures = [writer.submit(lambda session, row=row: session.merge(Saved(**row))) for row in rows]
+        for future in futures:
+            future.result()
+        _print_result("DBWriter, one job per row", count, time.perf_counter() - start)
+
+        # 3. 一个写操作批量INSERT OR REPLACE(SavedSnapshot.flush的写法), 同时进行读操作
+        rows = _make_saved_rows(count, version=2)
+        stop_event = threading.Event()
+        read_stats = []
+
+        def read_loop(index):
+            session = session_factory()
+            read_count, max_latency = 0, 0.0
+            try:
+                while not stop_event.is_set():
+                    read_start = time.perf_counter()
+                    session.query(Saved).filter(Saved.ID == "Item%05d" % ((read_count + index) % count)).one_or_none()
+                    session.rollback()
+                    max_latency = max(max_latency, time.perf_counter() - read_start)
+                    read_count += 1
+            finally:
+                session.close()
+            read_stats.append((read_count, max_latency))
+
+        reader_threads = [threading.Thread(target=read_loop, args=(i,)) for i in range(readers)]
+        for thread in reader_threads:
+            thread.start()
+        start = time.perf_counter()
+        writer.execute(
+            lambda session: session.execute(Saved.__table__.insert().prefix_with("OR REPLACE"), rows)
+        )
+        write_seconds = time.perf_counter() - start
+        stop_event.set()
+        for thread in reader_threads:
+            thread.join()
+        _print_result("DBWriter, batched upsert", count, write_seconds)
+        if read_stats:
+            print("%-36s %8d reads, max latency %.1f ms" % (
+                "Concurrent readers (%d)" % readers,
+                sum(x[0] for x in read_stats),
+                max(x[1] for x in read_stats) * 1000,
+            ))
+        writer.stop()
+        engine.dispose()
+
+# ---------------- 检查项目性能测试 ----------------
+
+# 本地服务器代替的上游主机
+_UPSTREAM_HOSTS = (
+    "sourceforge.net",
+    "h5ai.benchmark",
+    "api.aospextended.com",
+    "download.pixelexperience.org",
+    "www.pling.com",
+    "www.kernel.org",
+    "android.googlesource.com",
+)
+
+# PeCheck测试页面中有效的panel数量
+_PE_PANELS = 8
+
+_CLANG_LOG_PATH = "/platform/prebuilts/clang/host/linux-x86/+log"
+
+def _pad(head, filler, tail, size):
+    """ 在head与tail之间重复填充filler(i)生成的内容, 直到页面达到size字节 """
+    parts, length, i = [head], len(head) + len(tail), 0
+    while length < size:
+        part = filler(i)
+        parts.append(part)
+        length += len(part)
+        i += 1
+    parts.append(tail)
+    return "".join(parts)
+
+def _sf_page(project, size):
+    item = (
+        "<item><title>/{name}</title>"
+        "<guid>https://sourceforge.net/projects/{project}/files/{name}/download</guid>"
+        "<pubDate>Wed, 12 Feb 2020 12:34:{sec:02d} UT</pubDate>"
+        "<files:sf-file-id>{file_id}</files:sf-file-id>"
+        '<media:content filesize="{file_size}" type="application/zip">'
+        '<media:hash algo="md5">{md5}</media:hash></media:content></item>\n'
+    )
+    head = (
+        '<?xml version="1.0" encoding="utf-8"?>\n<rss version="2.0" '
+        'xmlns:files="https://sourceforge.net/api/files.rdf#" xmlns:media="http://video.search.yahoo.com/mrss/">'
+        "<channel><title>%s</title><lastBuildDate>%s</lastBuildDate>\n" % (project, time.ctime())
+        + item.format(
+            project=project, name="%s-latest.zip" % project, sec=59, file_id=10 ** 8,
+            file_size=900 * 1000 * 1000, md5=hashlib.md5(project.encode()).hexdigest(),
+        )
+    )
+    return _pad(head, lambda i: item.format(
+        project=project, name="%s-%d.txt" % (project, i), sec=i % 59, file_id=i,
+        file_size=1000, md5="%032x" % i,
+    ), "</channel></rss>\n", size)
+
+def _h5ai_page(path, size):
+    row = '<tr><td></td><td><a href="{path}{name}">{name}</a></td><td>{date}</td><td>{size}</td></tr>\n'
+    head = (
+        '<html><body><div id="fallback"><table>'
+        "<tr><th></th><th>Name</th><th>Last modified</th><th>Size</th></tr>\n"
+        + row.format(path=path, name="build-latest.zip", date="2020-02-12 12:34", size="900 MB")
+    )
+    return _pad(head, lambda i: row.format(
+        path=path, name="build-%d.zip" % i, date="2019-01-%02d 00:00" % (i % 28 + 1), size="900 MB"
+    ), "</table></div></body></html>\n", size)
+
+def _h5ai_json(href, size):
+    # h5ai的"get"接口返回目录本身 上级目录和目录中的全部文件, time为毫秒时间戳
+    item = {"href": href + "build-latest.zip", "time": 1581510840000, "size": 900 * 1048576, "managed": True}
+    items = [
+        {"href": "/", "time": 1581510840000, "size": None, "managed": True, "fetched": False},
+        {"href": href, "time": 1581510840000, "size": None, "managed": True, "fetched": True},
+        dict(item, href=href + "nightly/"),
+        item,
+    ]
+    length = len(json.dumps(items))
+    while length < size:
+        items.append(dict(
+            item, href="%sbuild-%d.zip" % (href, len(items)), time=1546300800000 + len(items) % 28 * 86400000
+        ))
+        length += len(json.dumps(items[-1])) + 2
+    return json.dumps({"items": items})
+
+def _aex_page(sub_path, size):
+    build = {
+        "file_name": "AospExtended-%s.zip" % sub_path.replace("/", "-"),
+        "file_size": 900 * 1048576,
+        "download_link": "https://downloads.aospextended.com/download/%s" % sub_path,
+        "md5": hashlib.md5(sub_path.encode()).hexdigest(),
+        "timestamp": 1581510896,
+        "changelog": "Benchmark build",
+    }
+    builds = [build]
+    while len(json.dumps(builds)) < size:
+        builds.append(dict(build, file_name="old-%d.zip" % len(builds), timestamp=len(builds)))
+    return json.dumps(builds)
+
+def _pe_page(size):
+    panel = (
+        '<div class="panel panel-collapse"><table><tbody><tr><td>2020-02-{day:02d}</td>'
+        '<td><a data-modal-id="modal{i}">PixelExperience_whyred-{i}.zip</a></td></tr></tbody></table></div>\n'
+        '<div id="modal{i}"><pre>Changelog {i}</pre><a data-file-uid="uid{i}" href="/changelog/{i}">Download</a>\n'
+        "MD5 hash: {md5}\nFile size: 900 MB\n</div>\n"
+    )
+    head = "<html><body>\n" + "".join(
+        panel.format(i=i, day=i + 1, md5="%032x" % i) for i in range(_PE_PANELS)
+    )
+    return _pad(head, lambda i: '<div class="changelog-item"><p>Older build %d</p></div>\n' % i,
+                "</body></html>\n", size)
+
+def _pling_page(p_id, size, query=""):
+    # 文件总数由size决定, 按请求中的page和perpage参数分页返回
+    params = parse_qs(query)
+    page = int(params.get("page", ["1"])[0])
+    perpage = int(params.get("perpage", ["1000"])[0])
+    files = []
+    latest = {
+        "id": p_id, "name": "build-%s-latest.zip" % p_id, "type": "application/zip",
+        "size": 900 * 1048576, "md5sum": hashlib.md5(p_id.encode()).hexdigest(),
+        "updated_timestamp": "2020-02-12 12:34:56", "tags": None,
+    }
+    while len(json.dumps(files)) < size:
+        files.append(dict(latest, id="%s%d" % (p_id, len(files)), name="build-%d.zip" % len(files)))
+    files.append(latest)
+    return json.dumps({"status": "success", "files": files[(page - 1) * perpage:page * perpage]})
+
+def _kernel_page(size):
+    row = "<tr><td>{kind}:</td><td><strong>{version}</strong></td><td>2020-02-12</td></tr>\n"
+    head = '<html><body><table id="releases">\n' + "".join(
+        row.format(kind=kind, version=version)
+        for kind, version in (("mainline", "5.6-rc7"), ("stable", "5.5.19"),
+                              ("longterm", "4.14.200"), ("longterm", "4.4.300"))
+    )
+    return _pad(head, lambda i: row.format(kind="eol", version="3.%d.1" % i),
+                "</table></body></html>\n", size)
+
+def _clang_log_page(size):
+    commit = (
+        '<li><a href="/platform/prebuilts/clang/host/linux-x86/+/{id}">{short}</a>'
+        '<a href="/platform/prebuilts/clang/host/linux-x86/+/{id}">{title}</a></li>\n'
+    )
+    head = (
+        '<html><body><ol class="CommitLog">\n'
+        + commit.format(id="%040x" % 1, short="%07x" % 1, title="Update prebuilt Clang to r383902.")
+    )
+    return _pad(head, lambda i: commit.format(
+        id="%040x" % (i + 2), short="%07x" % (i + 2), title="Remove old prebuilts %d" % i
+    ), "</ol></body></html>\n", size)
+
+def _fixture_page(host, path, size, query=""):
+    """
+    根据主机 路径和查询字符串生成测试页面
+    :return: (状态码, 页面源码)
+    """
+    if host == "sourceforge.net" and path.endswith("/rss"):
+        return 200, _sf_page(path.split("/")[2], size)
+    if host == "h5ai.benchmark":
+        if path == "/_h5ai/public/index.php":
+            return 200, _h5ai_json(parse_qs(query)["href"][0], size)
+        return 200, _h5ai_page(path, size)
+    if host == "api.aospextended.com":
+        return 200, _aex_page(path[len("/builds/"):], size)
+    if host == "download.pixelexperience.org":
+        if path.startswith("/download/"):
+            return 200, "https://download.pixelexperience.org/files/%s.zip" % path.split("/")[-1]
+        return 200, _pe_page(size)
+    if host == "www.pling.com":
+        return 200, _pling_page(path.split("/")[2], size, query)
+    if host == "www.kernel.org":
+        return 200, _kernel_page(size)
+    if host == "android.googlesource.com":
+        if path == _CLANG_LOG_PATH:
+            return 200, _clang_log_page(size)
+        return 200, ("<html><body><pre>Update prebuilt Clang to r383902.\n\n"
+                     "clang 11.0.1 (based on r383902) from build 6443078.\n</pre></body></html>")
+    return 404, ""
+
+class _FixtureServer(ThreadingHTTPServer):
+
+    """
+    代替上游主机的本地HTTP服务器, 请求路径的第一段为上游主机名
+    每个请求按latency秒延迟响应, 支持ETag条件请求, 同一路径的页面在服务器运行期间保持不变
+    服务器运行在子进程中, 避免与被测的检查流程争用GIL, requests和bytes_sent为进程间共享的计数
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, latency=0, size=32 * 1024, etag=True, counters=None):
+        super().__init__(("127.0.0.1", 0), _FixtureHandler)
+        self.latency = latency
+        self.size = size
+        self.etag = etag
+        self.__counters = counters
+        self.__pages = {}
+
+    def get_page(self, host, path, query=""):
+        key = (host, path, query)
+        page = self.__pages.get(key)
+        if page is None:
+            status_code, text = _fixture_page(host, path, self.size, query)
+            body = text.encode("utf-8")
+            page = self.__pages[key] = (status_code, body, '"%s"' % hashlib.sha1(body).hexdigest())
+        return page
+
+    def count(self, sent):
+        requests_count, bytes_sent = self.__counters
+        with requests_count.get_lock():
+            requests_count.value += 1
+            bytes_sent.value += sent
+
+def _run_fixture_server(port_pipe, counters, latency, size, etag):
+    server = _FixtureServer(latency, size, etag, counters)
+    port_pipe.send(server.server_port)
+    server.serve_forever()
+
+class _FixtureServerProcess:
+
+    """ 在子进程中运行_FixtureServer """
+
+    def __init__(self, latency=0, size=32 * 1024, etag=True):
+        self.__requests = multiprocessing.Value("q", 0)
+        self.__bytes_sent = multiprocessing.Value("q", 0)
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        self.__process = multiprocessing.Process(
+            target=_run_fixture_server, name="FixtureServer", daemon=True,
+            args=(sender, (self.__requests, self.__bytes_sent), latency, size, etag),
+        )
+        self.__process.start()
+        self.server_port = receiver.recv()
+
+    @property
+    def requests(self):
+        return self.__requests.value
+
+    @property
+    def bytes_sent(self):
+        return self.__bytes_sent.value
+
+    def shutdown(self):
+        self.__process.terminate()
+        self.__process.join()
+
+class _FixtureHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    # 响应头和正文分两次写入, 不禁用Nagle算法时每个keep-alive请求都会多等待一个delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        self.__respond(parts.path, parts.query)
+
+    def do_POST(self):
+        # 只用于h5ai的JSON接口, 请求正文中的目录路径转换为查询字符串, 以便与GET请求一样缓存页面
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        href = body.get("items", {}).get("href", "")
+        self.__respond(urlsplit(self.path).path, urlencode({"href": href}))
+
+    def __respond(self, url_path, query):
+        host, _, path = url_path.lstrip("/").partition("/")
+        status_code, body, etag = self.server.get_page(host, "/" + path, query)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.etag and status_code == 200 and self.headers.get("If-None-Match") == etag:
+            status_code, body = 304, b""
+        self.send_response(status_code)
+        if self.server.etag and status_code in (200, 304):
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(len(body))
+
+    def log_message(self, format, *args):
+        pass
+
+def _mount_fixture_server(session, port):
+    """ 将发往_UPSTREAM_HOSTS的请求转发到本地服务器, 请求路径的第一段为原来的主机名 """
+    from requests.adapters import HTTPAdapter
+
+    class LocalUpstreamAdapter(HTTPAdapter):
+
+        def send(self, request, **kwargs):
+            parts = urlsplit(request.url)
+            request.url = "http://127.0.0.1:%d/%s%s%s" % (
+                port, parts.hostname, parts.path or "/", "?" + parts.query if parts.query else ""
+            )
+            kwargs["proxies"] = {}
+            return super().send(request, **kwargs)
+
+    adapter = LocalUpstreamAdapter(pool_connections=len(_UPSTREAM_HOSTS), pool_maxsize=64)
+    for host in _UPSTREAM_HOSTS:
+        session.mount("https://%s/" % host, adapter)
+
+def _make_checkers(count):
+    """ 生成count个检查项目, 依次轮流使用各个检查类 """
+    from check_init import SfCheck, H5aiCheck, AexCheck, PeCheck, PlingCheck
+    from check_list import Linux44Y, Linux414Y, Linux55Y, Linux56Y, GoogleClangPrebuilt
+
+    kernel_classes = (Linux44Y, Linux414Y, Linux55Y, Linux56Y)
+    factories = (
+        lambda i: ("Sf", SfCheck, {"fullname": "Sf %d" % i, "project_name": "project%05d" % i}),
+        lambda i: ("H5ai", H5aiCheck, {
+            "fullname": "H5ai %d" % i, "base_url": "https://h5ai.benchmark", "sub_url": "/%05d/" % i
+        }),
+        lambda i: ("Aex", AexCheck, {"fullname": "Aex %d" % i, "sub_path": "device%05d/q" % i}),
+        lambda i: ("Pe", PeCheck, {"fullname": "Pe %d" % i, "key": i % _PE_PANELS}),
+        lambda i: ("Pling", PlingCheck, {"fullname": "Pling %d" % i, "p_id": "%05d" % i, "collection_id": 1}),
+        lambda i: ("Kernel", kernel_classes[i % len(kernel_classes)], {}),
+        lambda i: ("Clang", GoogleClangPrebuilt, {}),
+    )
+    checkers = []
+    for i in range(count):
+        family, base, attrs = factories[i % len(factories)](i)
+        checkers.append(type("Bench%s%05d" % (family, i), (base,), attrs))
+    return checkers
+
+def _get_metric_totals(metrics):
+    """ 将METRICS中的summary按(指标名, phase)汇总为{key: 总时间(秒)} """
+    totals = {}
+    for name, samples in metrics.to_dict()["metrics"].items():
+        for sample in samples:
+            if "sum" in sample:
+                key = "%s:%s" % (name, sample["labels"]["phase"]) if "phase" in sample["labels"] else name
+                totals[key] = totals.get(key, 0) + sample["sum"]
+    return totals
+
+def bench_checkers(count, latency, size, threads, cycles, etag):
+    """
+    用本地服务器代替上游主机, 对所有检查类生成count个检查项目, 按loop_check的流程进行多轮检查
+    第一轮数据库为空, 所有项目都有更新; 之后的各轮页面不变, 启用ETag时服务器返回304
+    统计每轮的耗时 各阶段的时间 请求速率和进程的峰值内存
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # database和logger在导入时按config中的相对路径创建文件, 因此先切换到临时目录
+        os.chdir(tmp_dir)
+        import http_session
+        import main
+        from database import SAVED_SNAPSHOT
+        from http_cache import CYCLE_CACHE
+        from metrics import METRICS
+        from rate_limiter import HostRateLimiter
+        from scheduler import Scheduler
+
+        server = _FixtureServerProcess(latency=latency, size=size * 1024, etag=etag)
+        _mount_fixture_server(http_session.get_session(), server.server_port)
+        # 测试的是检查流程本身的开销, 不限制请求速率, 也不发送消息
+        http_session.RATE_LIMITER = HostRateLimiter(default=(10 ** 9, 10 ** 9), hosts={})
+        main.ENABLE_MULTI_THREAD = threads > 1
+        main.MAX_THREADS_NUM = max(threads, 1)
+        main.DONT_POST = True
+        # 测试页面中的sf rss是XML, 与线上一样用HTML解析器解析, 忽略bs4的提示
+        warnings.filterwarnings("ignore", message=".*HTML parser to parse an XML document")
+
+        checkers = _make_checkers(count)
+        start = time.perf_counter()
+        scheduler = Scheduler(checkers)
+        due_list = scheduler.pop_due()
+        print("%-36s %8d items in %7.3fs" % ("Build scheduler & pop due items", len(due_list),
+                                              time.perf_counter() - start))
+
+        for cycle in range(1, cycles + 1):
+            totals_before = _get_metric_totals(METRICS)
+            requests_before, bytes_before = server.requests, server.bytes_sent
+            start = time.perf_counter()
+            CYCLE_CACHE.new_cycle()
+            SAVED_SNAPSHOT.reload()
+            with redirect_stdout(io.StringIO()):
+                failed_list = main.check_items(due_list)
+            SAVED_SNAPSHOT.flush()
+            wall_time = time.perf_counter() - start
+            scheduler.reschedule(due_list)
+
+            requests_count = server.requests - requests_before
+            print("Cycle %d: %d items, %d failed, %.3fs wall, %d requests (%.1f req/s), %.1f MB received, %s" % (
+                cycle, len(due_list), len(failed_list), wall_time, requests_count,
+                requests_count / wall_time, (server.bytes_sent - bytes_before) / 1048576,
+                CYCLE_CACHE.get_stats_text().lower(),
+            ))
+            totals = _get_metric_totals(METRICS)
+            for key in sorted(totals):
+                seconds = totals[key] - totals_before.get(key, 0)
+                if seconds:
+                    print("    %-40s %9.3fs (summed over threads)" % (key, seconds))
+            if failed_list:
+                print("    failed: %s" % ", ".join(x.__name__ for x in failed_list[:10]))
+
+        # Linux下ru_maxrss的单位为KB
+        print("Peak RSS: %.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+        server.shutdown()
+        os.chdir("/")
+
+# ---------------- 启动时间测试 ----------------
+
+# 启动时间测试的场景: (名称, 在子进程中执行的代码)
+_STARTUP_SCENARIOS = (
+    ("import main", "import main"),
+    ("import main + first get_bs", "import main, check_init; check_init.CheckUpdate.get_bs('<p></p>')"),
+    ("import main + create bot", "import main, tgbot; tgbot.get_bot()"),
+)
+
+# 需要单独列出导入时间的第三方库
+_HEAVY_MODULES = ("requests", "sqlalchemy", "bs4", "lxml", "html5lib", "telebot")
+
+def _parse_importtime(stderr):
+    """
+    解析-X importtime的输出
+    :return: {模块名: 累计导入时间(微秒)}, 只包含顶层导入(不包括被其他模块间接导入的部分)的总时间另外以None为key给出
+    """
+    result = {None: 0}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        result.setdefault(name, int(cumulative))
+        if level == 0:
+            result[None] += int(cumulative)
+    return result
+
+def _select_h5ai_by_sort(html_text):
+    """ 改为单次遍历之前的H5aiCheck选择方式: 对全部行按日期排序后取第一个.zip文件, 作为对比基准 """
+    from check_init import CheckUpdate
+
+    bs_obj = CheckUpdate.get_bs(html_text, parse_only=("div", {"id": "fallback"}))
+    trs = bs_obj.find("div", {"id": "fallback"}).find("table").find_all("tr")[1:]
+    trs.sort(key=lambda x: x.find_all("td")[2].get_text(), reverse=True)
+    build = list(filter(lambda x: x.find("a").get_text().endswith(".zip"), trs))[0]
+    return build.find("a").get_text()
+
+def bench_h5ai(size, repeat):
+    """
+    比较H5aiCheck在一个很大的目录上的几种选择最新文件的方式(不经过网络, 只测量解析和选择)
+    每种方式执行repeat次, 取中位数
+    """
+    from check_init import H5aiCheck
+    from http_cache import CYCLE_CACHE
+
+    href = "/builds/"
+    html_text = _h5ai_page(href, size)
+    json_text = _h5ai_json(href, size)
+    rows = html_text.count("<tr>") - 1
+    items = json_text.count('"href"')
+    print("HTML listing: %d rows, %.1f KB; JSON listing: %d items, %.1f KB" % (
+        rows, len(html_text) / 1024, items, len(json_text) / 1024
+    ))
+    scenarios = (
+        ("HTML, sort all rows (old)", rows, lambda: _select_h5ai_by_sort(html_text)),
+        ("HTML, single pass", rows, lambda: H5aiCheck.parse_html_listing(html_text)["LATEST_VERSION"]),
+        ("JSON API, single pass", items, lambda: H5aiCheck.parse_json_listing(json_text, href)["LATEST_VERSION"]),
+    )
+    for title, count, func in scenarios:
+        durations = []
+        for _ in range(repeat):
+            # get_bs会在同一轮检查中缓存解析结果, 每次都开始新的一轮
+            CYCLE_CACHE.new_cycle()
+            start = time.perf_counter()
+            result = func()
+            durations.append(time.perf_counter() - start)
+        assert result == "build-latest.zip", result
+        _print_result(title, count, statistics.median(durations))
+
+class _FileServer(ThreadingHTTPServer):
+
+    """
+    本地的文件服务器, 用于测试file_hash: /file.bin返回随机内容的文件, /SHA256SUMS /BSDSUMS返回校验文件
+    前drops次响应只发送drop_size字节就关闭连接(Content-Length仍为完整长度), 以模拟下载中断
+    range_support为False时忽略Range请求, 总是返回完整文件
+    """
+
+    daemon_threads = True
+
+    def __init__(self, data, manifests, drop_size):
+        super().__init__(("127.0.0.1", 0), _FileHandler)
+        self.data = data
+        self.manifests = manifests
+        self.drop_size = drop_size
+        self.drops = 0
+        self.range_support = True
+        self.requests = 0
+        self.range_requests = 0
+        self.lock = threading.Lock()
+
+class _FileHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    etag = '"file-bin"'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        path = urlsplit(self.path).path
+        if path in server.manifests:
+            body = server.manifests[path]
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if path != "/file.bin":
+            self.send_error(404)
+            return
+        start = 0
+        range_header = self.headers.get("Range")
+        with server.lock:
+            server.requests += 1
+            drop = server.drops > 0
+            if drop:
+                server.drops -= 1
+            if range_header and server.range_support and self.headers.get("If-Range") == self.etag:
+                server.range_requests += 1
+                start = int(range_header[len("bytes="):].rstrip("-"))
+        body = server.data[start:]
+        if start:
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(server.data) - 1, len(server.data)))
+        else:
+            self.send_response(200)
+        self.send_header("ETag", self.etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if drop:
+            self.wfile.write(body[:server.drop_size])
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+def _make_manifests(data, lines):
+    """ 生成GNU和BSD格式的校验文件, file.bin位于最后一行, 以测量完整扫描的开销 """
+    sha256 = hashlib.sha256(data).hexdigest()
+    gnu = ["%064x  other/file-%06d.zip" % (i, i) for i in range(lines)]
+    gnu.append("%s *dist/file.bin" % sha256)
+    bsd = ["SHA256 (file-%06d.zip) = %064x" % (i, i) for i in range(lines)]
+    bsd.append("SHA256 (file.bin) = %s" % sha256.upper())
+    return {
+        "/SHA256SUMS": ("\n".join(gnu) + "\n").encode("utf-8"),
+        "/BSDSUMS": ("\n".join(bsd) + "\n").encode("utf-8"),
+    }
+
+def bench_verify(size, drops, manifest_lines):
+    """
+    在本地的文件服务器上测试file_hash.hash_url(包括断点续传和服务器不支持Range时的重新下载)
+    与find_hash_in_manifest, 检查计算结果是否正确并输出吞吐量
+    """
+    from file_hash import hash_url, find_hash_in_manifest, HASH_KEYS
+    from rate_limiter import HostRateLimiter
+    import http_session
+
+    # 只测量下载和计算哈希值的开销, 不受速率限制影响
+    http_session.RATE_LIMITER = HostRateLimiter(default=(10 ** 9, 10 ** 9), hosts={})
+    data = os.urandom(size)
+    expected = {algorithm: hashlib.new(algorithm, data).hexdigest() for algorithm in HASH_KEYS.values()}
+    manifests = _make_manifests(data, manifest_lines)
+    # 即使超过max_resumes次中断也不会在最后一次中断时恰好发送完整个文件
+    server = _FileServer(data, manifests, drop_size=max(size // (drops + 2), 1))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = "http://127.0.0.1:%d" % server.server_address[1]
+    # 不使用config.py中配置的代理
+    kwargs = {"proxies": {}, "max_resumes": drops}
+    try:
+        for title, range_support, drop_count in (
+            ("hash_url", True, 0),
+            ("hash_url, %d drops, resumed" % drops, True, drops),
+            ("hash_url, %d drops, no Range" % drops, False, drops),
+        ):
+            server.range_support = range_support
+            server.drops = drop_count
+            server.requests = server.range_requests = 0
+            start = time.perf_counter()
+            digests, file_size = hash_url(base_url + "/file.bin", **kwargs)
+            duration = time.perf_counter() - start
+            assert digests == expected and file_size == size, (title, digests)
+            assert server.requests == drop_count + 1, (title, server.requests)
+            assert server.range_requests == (drop_count if range_support else 0), (title, server.range_requests)
+            _print_result(title, size // 1024, duration, unit="KB")
+        # 超过max_resumes时应该抛出异常, 而不是返回不完整文件的哈希值
+        server.range_support = True
+        server.drops = drops + 1
+        try:
+            hash_url(base_url + "/file.bin", **kwargs)
+        except Exception:
+            pass
+        else:
+            raise AssertionError("hash_url returned after too many drops")
+        for path in ("/SHA256SUMS", "/BSDSUMS"):
+            start = time.perf_counter()
+            result = find_hash_in_manifest(base_url + path, "https://example.com/dist/file.bin", proxies={})
+            duration = time.perf_counter() - start
+            assert result == expected["sha256"], (path, result)
+            _print_result("find_hash_in_manifest %s" % path, manifest_lines + 1, duration, unit="lines")
+        result = find_hash_in_manifest(base_url + "/SHA256SUMS", "missing.bin", proxies={})
+        assert result is None, result
+    finally:
+        server.shutdown()
+        server.server_close()
+
+class _SharedPageHandler(BaseHTTPRequestHandler):
+
+    """ 所有路径都返回同一个页面, 支持ETag条件请求 """
+
+    protocol_version = "HTTP/1.1"
+    etag = '"E1"'
+    body = b"4.14.200"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests += 1
+        status_code, body = 200, self.body
+        if self.headers.get("If-None-Match") == self.etag:
+            status_code, body = 304, b""
+        self.send_response(status_code)
+        self.send_header("ETag", self.etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def bench_cassette():
+    """
+    两个项目请求同一个url, 但上次检查保存的ETag不同: 一个与服务器返回的相同(没有更新), 一个不同(有更新)
+    分别在直接请求 磁盘缓存 录制和回放时按两种顺序检查, 确认每个项目都按自己保存的ETag判断是否有更新
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # database和logger在导入时按config中的相对路径创建文件, 因此先切换到临时目录
+        os.chdir(tmp_dir)
+        import http_session
+        from cassette import CASSETTE
+        from check_init import CheckUpdate, NotModified
+        from database import SAVED_SNAPSHOT, Saved, HttpValidator
+        from disk_cache import DISK_CACHE
+        from http_cache import CYCLE_CACHE
+        from rate_limiter import HostRateLimiter
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _SharedPageHandler)
+        server.daemon_threads = True
+        server.requests = 0
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:%d/releases" % server.server_address[1]
+        http_session.RATE_LIMITER = HostRateLimiter(default=(10 ** 9, 10 ** 9), hosts={})
+        DISK_CACHE.enabled = False
+
+        class SharedPage(CheckUpdate):
+
+            def do_check(self):
+                self.update_info("LATEST_VERSION", self.request_url(url, proxies={}))
+
+        checkers = {
+            # 上次检查时保存的ETag与服务器的相同, 应视为没有变化
+            type("SeenItem", (SharedPage,), {"fullname": "Seen item"}): ("4.4.300", '"E1"'),
+            # 上次检查时保存的ETag已经过时, 应解析出新版本
+            type("StaleItem", (SharedPage,), {"fullname": "Stale item"}): ("4.14.199", '"E0"'),
+        }
+        for cls, (version, etag) in checkers.items():
+            SAVED_SNAPSHOT.add(Saved, ID=cls.__name__, FULL_NAME=cls.fullname, LATEST_VERSION=version)
+            SAVED_SNAPSHOT.add(HttpValidator, ID=cls.__name__, URL=url, ETAG=etag, LAST_MODIFIED=None)
+        SAVED_SNAPSHOT.flush()
+
+        def check_all(order):
+            CYCLE_CACHE.new_cycle()
+            results = {}
+            for cls in order:
+                cls_obj = cls()
+                try:
+                    cls_obj.run_do_check()
+                    results[cls.__name__] = cls_obj.info_dic["LATEST_VERSION"]
+                except NotModified:
+                    results[cls.__name__] = None
+            assert results == {"SeenItem": None, "StaleItem": "4.14.200"}, results
+
+        cassette_file = os.path.join(tmp_dir, "cassette.jsonl.gz")
+        modes = (
+            ("direct requests", lambda: None, lambda: None),
+            ("disk cache",
+             lambda: setattr(DISK_CACHE, "enabled", True), lambda: setattr(DISK_CACHE, "enabled", False)),
+            ("record", lambda: CASSETTE.start_recording(cassette_file), CASSETTE.close),
+            ("replay", lambda: CASSETTE.start_replay(cassette_file), lambda: None),
+        )
+        try:
+            for title, start_mode, stop_mode in modes:
+                start_mode()
+                requests_before = server.requests
+                start = time.perf_counter()
+                for order in (list(checkers), list(reversed(list(checkers)))):
+                    check_all(order)
+                duration = time.perf_counter() - start
+                stop_mode()
+                print("%-36s ok, %d requests in %7.3fs" % (title, server.requests - requests_before, duration))
+        finally:
+            server.shutdown()
+            server.server_close()
+            os.chdir("/")
+
+def bench_startup(repeat):
+    """
+    在临时目录中用新的Python进程执行_STARTUP_SCENARIOS中的代码, 统计进程的总耗时和-X importtime给出的导入时间
+    每个场景执行repeat次, 取中位数
+    """
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for title, code in _STARTUP_SCENARIOS:
+            wall_times, import_times = [], []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                process = subprocess.run(
+                    [sys.executable, "-X", "importtime", "-c", code],
+                    cwd=tmp_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                    universal_newlines=True,
+                )
+                wall_times.append(time.perf_counter() - start)
+                if process.returncode != 0:
+                    print("%s failed:\n%s" % (title, process.stderr[-2000:]))
+                    return
+                import_times.append(_parse_importtime(process.stderr))
+            last = import_times[-1]
+            print("%-36s wall %7.1f ms, imports %7.1f ms" % (
+                title,
+                statistics.median(wall_times) * 1000,
+                statistics.median(x[None] for x in import_times) / 1000,
+            ))
+            print("    " + ", ".join(
+                "%s %.1f ms" % (name, last[name] / 1000) if name in last else "%s -" % name
+                for name in _HEAVY_MODULES
+            ))
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    db_parser = subparsers.add_parser("db", help="Benchmark writing Saved rows to SQLite")
+    db_parser.add_argument("-n", "--rows", help="Number of rows", type=int, default=5000)
+    db_parser.add_argument("--readers", help="Number of concurrent reader threads", type=int, default=4)
+
+    checkers_parser = subparsers.add_parser(
+        "checkers", help="Benchmark check cycles against a local stand-in upstream server"
+    )
+    checkers_parser.add_argument("-n", "--items", help="Number of generated items", type=int, default=700)
+    checkers_parser.add_argument("--latency", help="Server latency per request (seconds)", type=float, default=0.02)
+    checkers_parser.add_argument("--size", help="Approximate size of each page (KB)", type=int, default=32)
+    checkers_parser.add_argument("--threads", help="Number of worker threads (1 = sequential)", type=int, default=8)
+    checkers_parser.add_argument("--cycles", help="Number of check cycles", type=int, default=2)
+    checkers_parser.add_argument("--no-etag", help="Do not support conditional requests", action="store_true")
+
+    h5ai_parser = subparsers.add_parser("h5ai", help="Benchmark H5aiCheck listing parsing on a large directory")
+    h5ai_parser.add_argument("--size", help="Approximate size of the listing (KB)", type=int, default=1024)
+    h5ai_parser.add_argument("--repeat", help="Number of runs per method", type=int, default=5)
+
+    verify_parser = subparsers.add_parser("verify", help="Test and benchmark file verification against a local server")
+    verify_parser.add_argument("--size", help="Size of the test file (MB)", type=int, default=64)
+    verify_parser.add_argument("--drops", help="Number of dropped connections while downloading", type=int, default=3)
+    verify_parser.add_argument("--manifest-lines", help="Number of lines in the manifests", type=int, default=20000)
+
+    subparsers.add_parser(
+        "cassette", help="Check items sharing a URL with different ETags in every request_url mode"
+    )
+
+    startup_parser = subparsers.add_parser("startup", help="Benchmark startup and import time")
+    startup_parser.add_argument("--repeat", help="Number of runs per scenario", type=int, default=5)
+
+    args = parser.parse_args()
+
+    if args.command == "db":
+        bench_db(args.rows, args.readers)
+    elif args.command == "checkers":
+        bench_checkers(args.items, args.latency, args.size, args.threads, args.cycles, not args.no_etag)
+    elif args.command == "h5ai":
+        bench_h5ai(args.size * 1024, args.repeat)
+    elif args.command == "verify":
+        bench_verify(args.size * 1024 * 1024, args.drops, args.manifest_lines)
+    elif args.command == "cassette":
+        bench_cassette()
+    elif args.command == "startup":
+        bench_startup(args.repeat)
+    else:
+        parser.print_usage()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import atexit
+import gzip
+import hashlib
+import json
+import threading
+
+import requests
+
+class CassetteMiss(requests.exceptions.RequestException):
+    """ 自定义异常, 回放时录像中没有对应的请求时抛出 """
+
+class Cassette:
+
+    """
+    request_url的录制/回放
+    录制时每个经过request_url的请求及其完整响应依次追加到gzip压缩的JSON-lines文件中,
+    回放时所有请求都从该文件中读取, 不会访问网络, 可以在真实的上游数据上重复测量解析 数据库和调度的开销,
+    或离线复现解析失败的问题
+    同一个请求被录制了多次时(如录制了多轮检查), 回放时按录制的顺序依次返回, 用完后一直返回最后一次的响应
+    录制时不发送条件请求, 以便保存完整的响应, 录制和回放时都由request_url按保存的ETag/Last-Modified模拟304
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__file = None
+        self.__responses = None
+        self.__positions = {}
+
+    @property
+    def recording(self):
+        return self.__file is not None
+
+    @property
+    def replaying(self):
+        return self.__responses is not None
+
+    @staticmethod
+    def _hash_key(request_key):
+        return hashlib.sha1(repr(request_key).encode("utf-8")).hexdigest()
+
+    def start_recording(self, path):
+        """
+        开始录制, 覆盖已有的文件, 程序退出时自动关闭文件
+        :param path: 录像文件名(gzip压缩的JSON-lines)
+        """
+        with self.__lock:
+            self.__file = gzip.open(path, "wt", encoding="utf-8")
+        atexit.register(self.close)
+
+    def start_replay(self, path):
+        """
+        读取录像文件并开始回放
+        录制过程中被中断的文件(缺少gzip结尾)也可以回放, 已完整写入的请求都会被读取
+        :param path: 录像文件名
+        :return: 读取到的响应数量
+        """
+        responses = {}
+        count = 0
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            try:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # 被中断时最后一行可能不完整
+                        break
+                    responses.setdefault(entry["key"], []).append((
+                        entry["status_code"], entry["text"], entry["etag"], entry["last_modified"]
+                    ))
+                    count += 1
+            except EOFError:
+                pass
+        with self.__lock:
+            self.__responses = responses
+            self.__positions = {}
+        return count
+
+    def record(self, request_key, url, method, response):
+        """
+        录制一个请求的响应
+        :param request_key: http_cache.make_request_key生成的key(不包含条件请求头)
+        :param url: 请求的url, 只用于阅读录像文件
+        :param method: 请求方法, 只用于阅读录像文件
+        :param response: (status_code, text, etag, last_modified)
+        """
+        status_code, text, etag, last_modified = response
+        line = json.dumps({
+            "key": self._hash_key(request_key), "method": method, "url": url, "status_code": status_code,
+            "text": text, "etag": etag, "last_modified": last_modified,
+        }, ensure_ascii=False)
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.write(line + "\n")
+
+    def replay(self, request_key, url):
+        """
+        返回录制的响应
+        :param request_key: http_cache.make_request_key生成的key(不包含条件请求头)
+        :param url: 请求的url, 用于异常信息
+        :return: (status_code, text, etag, last_modified)
+        :raise CassetteMiss: 录像中没有这个请求时
+        """
+        key = self._hash_key(request_key)
+        with self.__lock:
+            responses = self.__responses.get(key)
+            if not responses:
+                raise CassetteMiss("Request not found in cassette: %s" % url)
+            position = self.__positions.get(key, 0)
+            self.__positions[key] = min(position + 1, len(responses) - 1)
+            return responses[position]
+
+    def close(self):
+        """ 停止录制并关闭录像文件 """
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+
+CASSETTE = Cassette()
@@ -1,18 +1,27 @@
 #!/usr/bin/env python3
 # encoding: utf-8
 
+import hashlib
 import json
 import random
+import re
+import threading
 import time
-from collections import OrderedDict
-from urllib.parse import unquote, urlencode
+from collections import OrderedDict, namedtuple
+from urllib.parse import unquote, urlencode, urlsplit
 
 import requests
-from bs4 import BeautifulSoup
+from requests.models import PreparedRequest
 from requests.packages import urllib3
 
+import http_session
+from http_cache import CYCLE_CACHE, make_request_key
+from cassette import CASSETTE
+from disk_cache import DISK_CACHE
+from file_hash import HASH_KEYS, HashMismatch, find_hash_in_manifest, hash_url
 from config import _PROXIES_DIC, TIMEOUT
-from database import DBSession, Saved
+from metrics import METRICS
+from database import SAVED_SNAPSHOT, Saved, HttpValidator, Fingerprint, Cursor
 
 # 禁用安全请求警告
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -54,14 +63,52 @@ def select_bs4_parser():
                 "Please install at least one parser in 'lxml' and 'html5lib'!"
             )
 
-BS4_PARSER = select_bs4_parser()
+_BS4_PARSER = None
+
+def get_bs4_parser():
+    """ 返回get_bs使用的解析器名称, 首次调用时才检测可用的解析器(同时会导入lxml或html5lib) """
+    global _BS4_PARSER
+    if _BS4_PARSER is None:
+        _BS4_PARSER = select_bs4_parser()
+    return _BS4_PARSER
+
+# request_url内部缓存的响应, status_code为304时text为None
+_Response = namedtuple("_Response", "status_code text etag last_modified")
+
+# 记录当前线程中正在执行do_check的CheckUpdate实例
+_THREAD_LOCAL = threading.local()
 
 class ErrorCode(requests.exceptions.RequestException):
     """ 自定义异常, 当requests请求结果返回错误代码时抛出 """
 
+class NotModified(Exception):
+    """ 自定义异常, 当条件请求返回304(页面自上次检查以来没有变化)时抛出 """
+
+class ContentUnchanged(NotModified):
+    """ 自定义异常, 当页面指纹与上次检查成功时相同时抛出 """
+
+def _get_checker_name():
+    checker = getattr(_THREAD_LOCAL, "checker", None)
+    return checker.name if checker is not None else ""
+
+def _get_full_url(url, params=None):
+    prepared_request = PreparedRequest()
+    prepared_request.prepare_url(url, params)
+    return prepared_request.url
+
 class CheckUpdate:
 
     fullname = None
+    # 是否允许在do_check中发送条件请求(If-None-Match/If-Modified-Since)
+    # 如果do_check的结果依赖于多个页面, 应将其设为False, 否则其中一个页面没有变化就会跳过整个检查
+    enable_conditional_request = True
+    # 是否根据页面指纹(页面源码的哈希值)跳过没有变化的页面, 适用于不支持条件请求的服务器
+    # 同样只适用于结果只依赖于一个页面的do_check
+    enable_fingerprint = False
+    # 计算页面指纹前需要从源码中删除的内容(正则表达式), 用于排除时间戳 CSRF token等易变内容
+    fingerprint_exclude_patterns = ()
+    # 发现更新后是否下载文件并校验哈希值(还需要启用ENABLE_FILE_VERIFY), 见verify_download
+    enable_file_verify = False
 
     def __init__(self):
         self._raise_if_missing_property("fullname")
@@ -78,11 +125,22 @@ class CheckUpdate:
             ("FILE_SIZE", None),
         ])
         self._private_dic = {}
+        self.__saved_validators = {}
+        self.__new_validators = {}
+        self.__saved_fingerprints = {}
+        self.__new_fingerprints = {}
+        self.__saved_cursor = None
+        self.__new_cursor = None
 
     @property
     def name(self):
         return self.__class__.__name__
 
+    @classmethod
+    def get_schedule_group(cls):
+        """ 返回调度分组, 同组的项目由Scheduler作为一个整体调度, 默认每个项目单独一组 """
+        return cls
+
     @property
     def info_dic(self):
         return self.__info_dic
@@ -103,48 +161,177 @@ class CheckUpdate:
         self.__info_dic[key] = str(value) if value is not None else None
 
     @staticmethod
-    def request_url(url, encoding="utf-8", **kwargs):
+    def request_url(url, encoding="utf-8", method="GET", **kwargs):
         """
-        对requests.get方法进行了简单的包装
+        对requests.get方法进行了简单的包装, 请求通过进程内共享的连接池发出
+        同一轮检查中相同的请求(url, params, 请求正文和除user-agent之外的请求头都相同)只会发出一次
+        GET请求在do_check中调用时, 会携带上次检查保存的ETag/Last-Modified发送条件请求,
+        服务器返回304时抛出NotModified异常, 页面指纹与上次相同时抛出ContentUnchanged异常
+        启用ENABLE_DISK_CACHE时, 没有过期的响应直接从磁盘缓存中读取, 不会发出请求
+        (缓存的ETag/Last-Modified与上次检查保存的相同时视为304)
+        录制时每个请求的完整响应都会保存到录像中, 回放时只从录像中读取, 见cassette.Cassette
         timeout, headers, proxies这三个参数有默认值, 也可以根据需要自定义这些参数
         :param url: 要请求的url
         :param encoding: 文本编码, 默认为utf-8
-        :param kwargs: 需要传递给requests.get方法的参数
+        :param method: 请求方法, 默认为GET, 也可以用于幂等的POST请求(如查询接口)
+        :param kwargs: 需要传递给requests.request方法的参数
         :return: url页面的源码
         """
         timeout = kwargs.pop("timeout", TIMEOUT)
         headers = kwargs.pop("headers", {"user-agent": random.choice(UAS)})
         proxies = kwargs.pop("proxies", _PROXIES_DIC)
-        req = requests.get(
-            url, timeout=timeout, headers=headers, proxies=proxies, **kwargs
+        checker = getattr(_THREAD_LOCAL, "checker", None)
+        full_url = _get_full_url(url, kwargs.get("params"))
+        validators = None
+        if checker is not None and method == "GET":
+            validators = checker.__saved_validators.get(full_url)
+        # 磁盘缓存和录像的key不包含条件请求头, 因此可以在不同的检查项目之间共享
+        request_key = make_request_key(url, headers=headers, encoding=encoding, method=method, **kwargs)
+        # 录制时不发送条件请求, 以便保存完整的响应
+        if validators is not None and not CASSETTE.recording:
+            headers = dict(headers)
+            etag, last_modified = validators
+            if etag is not None:
+                headers["If-None-Match"] = etag
+            if last_modified is not None:
+                headers["If-Modified-Since"] = last_modified
+
+        host = urlsplit(url).hostname
+        fetched = []
+
+        def fetch():
+            if CASSETTE.replaying:
+                fetched.append("replay")
+                response = _Response(*CASSETTE.replay(request_key, url))
+            else:
+                response = None
+                if DISK_CACHE.enabled:
+                    cached = DISK_CACHE.get(request_key, url)
+                    if cached is not None:
+                        fetched.append("disk_hit")
+                        response = _Response(*cached)
+                if response is None:
+                    fetched.append("miss")
+                    with METRICS.timer("http_request_seconds", checker=_get_checker_name(), host=host):
+                        req = http_session.request(
+                            method, url, timeout=timeout, headers=headers, proxies=proxies, **kwargs
+                        )
+                    METRICS.inc("http_response_bytes_total", len(req.content), host=host)
+                    if req.status_code == 304 and validators is not None:
+                        return _Response(304, None, None, None)
+                    req.encoding = encoding
+                    response = _Response(
+                        req.status_code, req.text, req.headers.get("ETag"), req.headers.get("Last-Modified")
+                    )
+                    if req.ok and req.status_code != 304 and DISK_CACHE.enabled:
+                        DISK_CACHE.put(request_key, url, response)
+                if CASSETTE.recording:
+                    CASSETTE.record(request_key, url, method, response)
+            if response.status_code >= 400 or response.status_code == 304:
+                raise ErrorCode(response.status_code)
+            return response
+
+        response = CYCLE_CACHE.get_or_create(
+            make_request_key(url, headers=headers, encoding=encoding, method=method, **kwargs), fetch
         )
-        if not req.ok:
-            raise ErrorCode(req.status_code)
-        req.encoding = encoding
-        return req.text
+        METRICS.inc("http_cache_total", host=host, result=fetched[0] if fetched else "hit")
+        if checker is not None:
+            if response.status_code == 304:
+                raise NotModified(full_url)
+            # 完整响应(磁盘缓存 录像 录制时的请求)可能由多个项目共享, 因此按每个项目自己保存的ETag/Last-Modified判断,
+            # 与上次检查保存的相同时按条件请求的语义视为304
+            if validators is not None and validators == (response.etag, response.last_modified):
+                raise NotModified(full_url)
+            if method == "GET" and (response.etag is not None or response.last_modified is not None):
+                checker.__new_validators[full_url] = (response.etag, response.last_modified)
+            if checker.enable_fingerprint:
+                fingerprint = checker.get_fingerprint(full_url, response.text)
+                if checker.__saved_fingerprints.get(full_url) == fingerprint:
+                    raise ContentUnchanged(full_url)
+                checker.__new_fingerprints[full_url] = fingerprint
+        return response.text
+
+    def fingerprint_normalize(self, url, url_text):
+        """
+        计算页面指纹前对源码进行规范化, 默认删除fingerprint_exclude_patterns匹配的内容
+        如有更复杂的需求, 可以在子类中重写此方法
+        :param url: 页面的url
+        :param url_text: 页面源码
+        :return: 规范化之后的源码
+        """
+        for pattern in self.fingerprint_exclude_patterns:
+            url_text = re.sub(pattern, "", url_text)
+        return url_text
+
+    def get_fingerprint(self, url, url_text):
+        """ 返回规范化之后的页面源码的SHA1值 """
+        return hashlib.sha1(self.fingerprint_normalize(url, url_text).encode("utf-8")).hexdigest()
 
     @classmethod
-    def get_hash_from_file(cls, url, **kwargs):
+    def get_hash_from_file(cls, url, filename=None, **kwargs):
         """
         请求哈希校验文件的url, 返回文件中的哈希值
         请求过程中发生任何异常都允许忽略
         :param url: 哈希校验文件的url
-        :param kwargs: 需要传递给self.request_url方法的参数
+        :param filename: 如果校验文件包含多个文件的哈希值(如SHA256SUMS), 传入要查找的文件名或下载链接,
+                         此时会流式扫描校验文件, 返回对应的哈希值; 为None时返回文件中的第一个哈希值
+        :param kwargs: 需要传递给self.request_url(filename不为None时为http_session.get)方法的参数
         :return: 哈希值字符串或None
         """
         try:
+            if filename is not None:
+                return find_hash_in_manifest(url, filename, **kwargs)
             return cls.request_url(url, **kwargs).strip().split()[0]
         except:
             return None
 
+    def verify_download(self, **kwargs):
+        """
+        流式下载DOWNLOAD_LINK, 一次性计算MD5 SHA1 SHA256, 与info_dic中已有的哈希值比对,
+        info_dic中缺少的哈希值会用计算结果补全
+        DOWNLOAD_LINK不是单个http(s)链接时不做任何事
+        :param kwargs: 需要传递给file_hash.hash_url方法的参数
+        :return: 是否进行了校验
+        :raise HashMismatch: 任一哈希值不一致时抛出
+        """
+        url = self.__info_dic["DOWNLOAD_LINK"]
+        if url is None or not url.startswith(("http://", "https://")):
+            return False
+        digests, size = hash_url(url, **kwargs)
+        mismatched = []
+        for key, algorithm in HASH_KEYS.items():
+            expected = self.__info_dic[key]
+            if expected is None:
+                self.update_info(key, digests[algorithm])
+            elif expected.lower() != digests[algorithm]:
+                mismatched.append("%s: expected %s, got %s" % (key, expected, digests[algorithm]))
+        if mismatched:
+            raise HashMismatch("%s (%d bytes): %s" % (url, size, "; ".join(mismatched)))
+        return True
+
     @staticmethod
-    def get_bs(url_text):
+    def get_bs(url_text, parse_only=None):
         """
         对BeautifulSoup函数进行了简单的包装
+        同一轮检查中相同的源码(及parse_only)只会解析一次, 返回的对象会被多个检查项目共享, 请不要修改它
         :param url_text: url源码
+        :param parse_only: 只解析页面中的指定区域, 可以节省解析时间和内存
+                           格式为(标签名, 属性字典), 与SoupStrainer的参数相同, 也可以直接传入SoupStrainer对象
+                           注意: html5lib解析器不支持此参数, 会忽略它并解析整个页面
         :return: BeautifulSoup对象
         """
-        return BeautifulSoup(url_text, BS4_PARSER)
+        # 只检查JSON接口的项目用不到bs4, 因此在第一次调用时才导入
+        from bs4 import BeautifulSoup, SoupStrainer
+
+        if isinstance(parse_only, tuple):
+            strainer = SoupStrainer(*parse_only)
+        else:
+            strainer = parse_only
+        def parse():
+            with METRICS.timer("parse_seconds", checker=_get_checker_name()):
+                return BeautifulSoup(url_text, get_bs4_parser(), parse_only=strainer)
+
+        return CYCLE_CACHE.get_or_create(("bs", url_text, repr(parse_only)), parse)
 
     def do_check(self):
         """
@@ -156,6 +343,62 @@ class CheckUpdate:
         # 如确实需要引用参数, 可以在继承时添加新的类属性
         raise NotImplementedError
 
+    def run_do_check(self, conditional=True):
+        """
+        执行do_check方法, 并记录期间通过request_url获取到的ETag/Last-Modified和页面指纹
+        如果允许跳过并且数据库中已有此项目的数据:
+        将携带上次保存的ETag/Last-Modified发送请求, 服务器返回304时抛出NotModified异常;
+        启用了enable_fingerprint时, 页面指纹与上次相同则抛出ContentUnchanged异常
+        这两种情况都不再进行解析, 不支持条件请求的服务器会直接返回200, 此时按正常流程处理
+        :param conditional: 是否允许跳过没有变化的页面
+        :return: None
+        """
+        self.__saved_validators = {}
+        self.__new_validators = {}
+        self.__saved_fingerprints = {}
+        self.__new_fingerprints = {}
+        self.__new_cursor = None
+        if conditional and Saved.get_saved_info(self.name) is not None:
+            if self.enable_conditional_request:
+                self.__saved_validators = HttpValidator.get_validators(self.name)
+            if self.enable_fingerprint:
+                self.__saved_fingerprints = Fingerprint.get_fingerprints(self.name)
+        _THREAD_LOCAL.checker = self
+        try:
+            self.do_check()
+        finally:
+            _THREAD_LOCAL.checker = None
+
+    def get_cursor(self):
+        """
+        返回上次检查成功时用set_cursor保存的游标, 没有保存过时返回None
+        游标从SAVED_SNAPSHOT中读取, 不会每次都查询数据库
+        """
+        if self.__saved_cursor is None:
+            self.__saved_cursor = (Cursor.get_cursor(self.name),)
+        return self.__saved_cursor[0]
+
+    def set_cursor(self, value):
+        """
+        设置增量检查的游标(可以转换为JSON的对象), 在检查成功后由save_check_state写入数据库
+        :param value: 游标, 如{"page": 3}
+        """
+        self.__new_cursor = value
+
+    def save_check_state(self):
+        """
+        将run_do_check期间获取到的ETag/Last-Modified, 页面指纹和游标写入数据库(与Saved数据一起批量写入)
+        应在检查成功完成后调用, 否则解析失败的页面可能在下次检查时被跳过
+        """
+        if self.__new_cursor is not None:
+            SAVED_SNAPSHOT.add(Cursor, ID=self.name, VALUE=json.dumps(self.__new_cursor))
+        for url, (etag, last_modified) in self.__new_validators.items():
+            SAVED_SNAPSHOT.add(
+                HttpValidator, ID=self.name, URL=url, ETAG=etag, LAST_MODIFIED=last_modified
+            )
+        for url, hash_ in self.__new_fingerprints.items():
+            SAVED_SNAPSHOT.add(Fingerprint, ID=self.name, URL=url, HASH=hash_)
+
     def after_check(self):
         """
         此方法将在确定检查对象有更新之后才会执行
@@ -167,24 +410,8 @@ class CheckUpdate:
         pass
 
     def write_to_database(self):
-        """ 将CheckUpdate实例的info_dic数据写入数据库 """
-        session = DBSession()
-        try:
-            if self.name in {x.ID for x in session.query(Saved).all()}:
-                saved_data = session.query(Saved).filter(Saved.ID == self.name).one()
-                saved_data.FULL_NAME = self.fullname
-                for key, value in self.__info_dic.items():
-                    setattr(saved_data, key, value)
-            else:
-                new_data = Saved(
-                    ID=self.name,
-                    FULL_NAME=self.fullname,
-                    **self.__info_dic
-                )
-                session.add(new_data)
-            session.commit()
-        finally:
-            session.close()
+        """ 将CheckUpdate实例的info_dic数据写入数据库(先暂存在SAVED_SNAPSHOT中, 稍后批量写入) """
+        SAVED_SNAPSHOT.add(Saved, ID=self.name, FULL_NAME=self.fullname, **self.__info_dic)
 
     def is_updated(self):
         """ 与数据库中已存储的数据进行比对, 如果有更新, 则返回True, 否则返回False """
@@ -228,10 +455,82 @@ class CheckUpdate:
             ])
         )
 
+class GroupCheck(CheckUpdate):
+
+    """
+    一个数据源对应多个检查项目的检查类
+    数据源的请求和解析在同一轮检查中只进行一次, 每个项目从解析结果中按key取出自己的数据,
+    但仍然有各自的Saved数据 is_updated判断和更新消息
+    子类需要实现get_source_text和parse_source方法, 然后用member方法声明各个项目, 例如:
+        Linux44Y = KernelCheck.member("Linux44Y", "Linux Kernel stable v4.4.y", "4.4")
+    """
+
+    key = None
+
+    def __init__(self):
+        self._raise_if_missing_property("key")
+        super().__init__()
+
+    @classmethod
+    def member(cls, name, fullname, key, **kwargs):
+        """
+        声明一个检查项目
+        :param name: 项目的类名(即数据库中的ID)
+        :param fullname: 项目的全名
+        :param key: 项目在parse_source返回的字典中对应的key
+        :param kwargs: 其他需要覆盖的类属性
+        :return: 新的子类
+        """
+        return type(name, (cls,), dict(kwargs, fullname=fullname, key=key))
+
+    @classmethod
+    def get_schedule_group(cls):
+        """ 同一个数据源(定义get_source_text的类)的所有成员为一组, 一起检查才能共享请求和解析 """
+        for klass in cls.__mro__:
+            if "get_source_text" in vars(klass):
+                return klass
+        return cls
+
+    def get_source_text(self):
+        """
+        请求数据源, 返回页面源码
+        应使用self.request_url请求, 这样同一轮检查中只会发出一次请求, 并且每个项目都可以使用条件请求
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def parse_source(cls, source_text):
+        """
+        解析数据源, 同一轮检查中相同的源码只会解析一次, 结果由所有项目共享, 请不要修改它
+        :param source_text: get_source_text返回的源码
+        :return: 字典, {key: {字段名: 值}}, 字段名为info_dic的键时更新info_dic, 否则存入_private_dic
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def get_results(cls, source_text):
+        """ 返回parse_source的解析结果, 同一轮检查中相同的源码只会解析一次 """
+        return CYCLE_CACHE.get_or_create(
+            ("group", cls.parse_source.__func__, source_text), lambda: cls.parse_source(source_text)
+        )
+
+    def do_check(self):
+        result = self.get_results(self.get_source_text()).get(self.key)
+        if result is None:
+            raise Exception("Parsing failed!")
+        for key, value in result.items():
+            if key in self.info_dic:
+                self.update_info(key, value)
+            else:
+                self._private_dic[key] = value
+
 class SfCheck(CheckUpdate):
 
     project_name = None
     sub_path = ""
+    enable_fingerprint = True
+    fingerprint_exclude_patterns = (r"<lastBuildDate>.*?</lastBuildDate>",)
+    enable_file_verify = True
 
     __MONTH_TO_NUMBER = {
         "Jan": "01",
@@ -254,7 +553,9 @@ class SfCheck(CheckUpdate):
 
     def do_check(self):
         url = "https://sourceforge.net/projects/%s/rss" % self.project_name
-        bs_obj = self.get_bs(self.request_url(url, params={"path": "/"+self.sub_path}))
+        bs_obj = self.get_bs(
+            self.request_url(url, params={"path": "/"+self.sub_path}), parse_only=("item",)
+        )
         builds = list(bs_obj.find_all("item"))
         if not builds:
             return
@@ -350,23 +651,122 @@ class SfProjectCheck(SfCheck):
 
 class H5aiCheck(CheckUpdate):
 
+    """
+    h5ai目录列表中最新的.zip文件
+    默认通过h5ai的JSON接口(POST api_path)只获取该目录的文件列表, 服务器不支持时改为解析HTML页面中的
+    div#fallback表格, 每个base_url的检测结果在进程内缓存
+    """
+
     base_url = None
     sub_url = None
+    # 是否尝试使用h5ai的JSON接口
+    enable_json_api = True
+    api_path = "/_h5ai/public/index.php"
+
+    # {base_url: 是否支持JSON接口}
+    _api_support = {}
 
     def __init__(self):
         self._raise_if_missing_property("base_url", "sub_url")
         super().__init__()
 
+    @staticmethod
+    def _is_newer(build, newest):
+        # 与按日期降序排序后取第一个相同, 日期相同时保留先出现的文件
+        return newest is None or build["BUILD_DATE"] > newest["BUILD_DATE"]
+
+    @classmethod
+    def parse_html_listing(cls, html_text):
+        """
+        从h5ai页面的div#fallback表格中选出日期最新的.zip文件, 只遍历一次表格
+        :param html_text: h5ai页面源码
+        :return: {"LATEST_VERSION", "BUILD_DATE", "FILE_SIZE", "href"}, 没有.zip文件时返回None
+        """
+        bs_obj = cls.get_bs(html_text, parse_only=("div", {"id": "fallback"}))
+        newest = None
+        for tr in bs_obj.find("div", {"id": "fallback"}).find("table").find_all("tr")[1:]:
+            link = tr.find("a")
+            if link is None or not link.get_text().endswith(".zip"):
+                continue
+            tds = tr.find_all("td")
+            build = {
+                "LATEST_VERSION": link.get_text(),
+                "BUILD_DATE": tds[2].get_text(),
+                "FILE_SIZE": tds[3].get_text(),
+                "href": tds[1].find("a")["href"],
+            }
+            if cls._is_newer(build, newest):
+                newest = build
+        return newest
+
+    @classmethod
+    def parse_json_listing(cls, json_text, sub_url):
+        """
+        从h5ai JSON接口的返回结果中选出sub_url目录下修改时间最新的.zip文件, 只遍历一次
+        :param json_text: 接口返回的JSON
+        :param sub_url: 目录路径
+        :return: 与parse_html_listing相同
+        """
+        sub_url = unquote(sub_url)
+        newest = None
+        newest_time = None
+        for item in json.loads(json_text)["items"]:
+            href = item["href"]
+            path = unquote(href)
+            if not path.startswith(sub_url):
+                continue
+            name = path[len(sub_url):]
+            # 跳过子目录和其他文件
+            if "/" in name or not name.endswith(".zip"):
+                continue
+            if newest_time is None or item["time"] > newest_time:
+                newest_time = item["time"]
+                newest = {
+                    "LATEST_VERSION": name,
+                    # time为毫秒时间戳, 格式与HTML页面中的日期相同
+                    "BUILD_DATE": time.strftime("%Y-%m-%d %H:%M", time.localtime(item["time"] / 1000)),
+                    "FILE_SIZE": "%0.2f MB" % (int(item["size"]) / 1048576,),
+                    "href": href,
+                }
+        return newest
+
+    def get_newest_from_api(self):
+        """
+        通过JSON接口获取最新的文件
+        :return: 与parse_html_listing相同
+        :raise ErrorCode, ValueError, KeyError, TypeError: 服务器不支持JSON接口或出错时
+        """
+        json_text = self.request_url(
+            self.base_url + self.api_path,
+            method="POST",
+            json={"action": "get", "items": {"href": self.sub_url, "what": 1}},
+            verify=False,
+        )
+        return self.parse_json_listing(json_text, self.sub_url)
+
     def do_check(self):
-        url = self.base_url + self.sub_url
-        bs_obj = self.get_bs(self.request_url(url, verify=False))
-        trs = bs_obj.find("div", {"id": "fallback"}).find("table").find_all("tr")[1:]
-        trs.sort(key=lambda x: x.find_all("td")[2].get_text(), reverse=True)
-        build = list(filter(lambda x: x.find("a").get_text().endswith(".zip"), trs))[0]
-        self.update_info("LATEST_VERSION", build.find("a").get_text())
-        self.update_info("BUILD_DATE", build.find_all("td")[2].get_text())
-        self.update_info("DOWNLOAD_LINK", self.base_url + build.find_all("td")[1].find("a")["href"])
-        self.update_info("FILE_SIZE", build.find_all("td")[3].get_text())
+        use_api = self.enable_json_api and H5aiCheck._api_support.get(self.base_url) is not False
+        if use_api:
+            try:
+                newest = self.get_newest_from_api()
+                H5aiCheck._api_support[self.base_url] = True
+            except (ErrorCode, ValueError, KeyError, TypeError) as error:
+                # 已确认支持JSON接口的服务器出错时按检查失败处理, 不改用HTML页面
+                if H5aiCheck._api_support.get(self.base_url):
+                    raise
+                # 只有返回无法解析的内容或4xx(接口不存在/被禁止)才说明不支持JSON接口,
+                # 5xx等临时错误只在这次检查中改用HTML页面, 下次检查时再尝试JSON接口
+                if not isinstance(error, ErrorCode) or 400 <= error.args[0] < 500:
+                    H5aiCheck._api_support[self.base_url] = False
+                use_api = False
+        if not use_api:
+            newest = self.parse_html_listing(self.request_url(self.base_url + self.sub_url, verify=False))
+        if newest is None:
+            raise Exception("Parsing failed!")
+        self.update_info("LATEST_VERSION", newest["LATEST_VERSION"])
+        self.update_info("BUILD_DATE", newest["BUILD_DATE"])
+        self.update_info("DOWNLOAD_LINK", self.base_url + newest["href"])
+        self.update_info("FILE_SIZE", newest["FILE_SIZE"])
 
 class AexCheck(CheckUpdate):
 
@@ -394,59 +794,68 @@ class AexCheck(CheckUpdate):
         self.update_info("BUILD_DATE", json_dic["timestamp"])
         self.update_info("BUILD_CHANGELOG", json_dic.get("changelog"))
 
-class PeCheckPageCache:
-
-    def __init__(self):
-        self.cache = None
+class PeCheck(GroupCheck):
 
-    clear = __init__
+    """ download.pixelexperience.org的构建页面, 页面中的每个panel对应一个项目, key为panel的序号(从0开始) """
 
-class PeCheck(CheckUpdate):
+    base_url = "https://download.pixelexperience.org"
 
-    index = None
-    page_cache = None
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # 兼容之前的写法: 在子类中用index指定panel的序号
+        if "index" in vars(cls):
+            index = vars(cls)["index"]
+            delattr(cls, "index")
+            if "key" not in vars(cls):
+                cls.key = index
 
-    def __init__(self):
-        self._raise_if_missing_property("index")
-        if not (self.page_cache is None or isinstance(self.page_cache, PeCheckPageCache)):
-            raise Exception(
-                "'page_cache' property must be NoneType or PeCheckPageCache object!"
-            )
-        super().__init__()
+    @property
+    def index(self):
+        """ panel的序号, 即key """
+        return self.key
 
-    def do_check(self):
-        url = "https://download.pixelexperience.org"
-        if self.page_cache is None:
-            bs_obj = self.get_bs(self.request_url(url + "/whyred"))
-        elif self.page_cache.cache is None:
-            bs_obj = self.get_bs(self.request_url(url + "/whyred"))
-            self.page_cache.cache = bs_obj
-        else:
-            bs_obj = self.page_cache.cache
-        build = bs_obj.find_all("div", {"class": "panel panel-collapse"})[self.index]
-        build_info = build.find("tbody").find("tr").find_all("td")
-        self.update_info("BUILD_DATE", build_info[0].get_text())
-        self.update_info("LATEST_VERSION", build_info[1].get_text().strip())
+    @staticmethod
+    def _extract_build(panel, modal_divs):
+        build_info = panel.find("tbody").find("tr").find_all("td")
         build_id = build_info[1].find("a")["data-modal-id"]
-        build_info_sp_div = bs_obj.find("div", {"id": build_id})
-        self.update_info("BUILD_CHANGELOG", build_info_sp_div.find("pre").get_text())
+        build_info_sp_div = modal_divs[build_id]
+        build = {
+            "BUILD_DATE": build_info[0].get_text(),
+            "LATEST_VERSION": build_info[1].get_text().strip(),
+            "BUILD_CHANGELOG": build_info_sp_div.find("pre").get_text(),
+            "FILE_MD5": None,
+            "FILE_SIZE": None,
+            "file_uid": build_info_sp_div.find("a")["data-file-uid"],
+            "href": build_info_sp_div.find("a")["href"],
+        }
         for line in build_info_sp_div.get_text().splitlines():
             if "MD5 hash: " in line:
-                self.update_info("FILE_MD5", line.strip().split(": ")[1])
+                build["FILE_MD5"] = line.strip().split(": ")[1]
             if "File size: " in line:
-                self.update_info("FILE_SIZE", line.strip().split(": ")[1])
-        self._private_dic = {
-            "fake_download_link": "".join([
-                url, "/download/", build_info_sp_div.find("a")["data-file-uid"]
-            ]),
-            "request_headers_referer": url + build_info_sp_div.find("a")["href"],
-        }
+                build["FILE_SIZE"] = line.strip().split(": ")[1]
+        return build
+
+    def get_source_text(self):
+        return self.request_url(self.base_url + "/whyred")
+
+    @classmethod
+    def parse_source(cls, source_text):
+        bs_obj = cls.get_bs(source_text)
+        modal_divs = {div["id"]: div for div in bs_obj.find_all("div", id=True)}
+        builds = {}
+        for index, panel in enumerate(bs_obj.find_all("div", {"class": "panel panel-collapse"})):
+            try:
+                builds[index] = cls._extract_build(panel, modal_divs)
+            except (AttributeError, IndexError, KeyError, TypeError):
+                # 解析失败的panel不放入结果, 对应的项目会抛出"Parsing failed!"
+                pass
+        return builds
 
     def after_check(self):
         real_download_link = self.request_url(
-            self._private_dic["fake_download_link"],
+            "".join([self.base_url, "/download/", self._private_dic["file_uid"]]),
             headers={
-                "referer": self._private_dic["request_headers_referer"],
+                "referer": self.base_url + self._private_dic["href"],
                 "user-agent": UAS[0],
             }
         )
@@ -454,26 +863,84 @@ class PeCheck(CheckUpdate):
 
 class PlingCheck(CheckUpdate):
 
+    """
+    pling.com的文件列表接口按上传时间升序分页返回文件, 最新的文件是最后一个非空页面的最后一项
+    每次只请求perpage个文件, 并将最后一个非空页面的页码作为游标保存, 下次检查从该页开始,
+    通常只需要一到两个请求, 请求量和解码的数据量与文件总数无关
+    第一次检查(没有游标)时先按1, 2, 4, 8...倍增页码, 再二分查找最后一个非空页面
+    """
+
     p_id = None
     collection_id = None
+    perpage = 50
+    # 检查结果依赖于多个页面, 某一页没有变化时并不能说明没有更新
+    enable_conditional_request = False
 
     def __init__(self):
         self._raise_if_missing_property("p_id", "collection_id")
         super().__init__()
 
-    def do_check(self):
+    def get_files(self, page):
+        """
+        请求文件列表的第page页(从1开始)
+        :return: 文件字典的列表, 页码超出范围时为空列表
+        """
         url = "https://www.pling.com/p/%s/getfilesajax" % self.p_id
         params = {
             "format": "json",
             "ignore_status_code": 1,
             "status": "all",
             "collection_id": self.collection_id,
-            "perpage": 1000,
-            "page": 1,
+            "perpage": self.perpage,
+            "page": page,
         }
-        json_dic = json.loads(self.request_url(url, params=params))
-        if json_dic["files"]:
-            latest_build = json_dic["files"][-1]
+        return json.loads(self.request_url(url, params=params))["files"]
+
+    def find_last_page(self, page=1):
+        """
+        从page页开始查找最后一个非空页面
+        :param page: 上次保存的游标, 即上次的最后一个非空页面
+        :return: (页码, 该页的文件列表), 没有任何文件时为(1, [])
+        """
+        files = self.get_files(page)
+        if not files:
+            # 游标之后的文件被删除了, 从头查找
+            if page == 1:
+                return 1, []
+            return self.find_last_page()
+        if len(files) < self.perpage:
+            return page, files
+        # 当前页已满, 倍增页码直到遇到未满的页面
+        step = 1
+        while True:
+            next_page = page + step
+            next_files = self.get_files(next_page)
+            if len(next_files) == self.perpage:
+                page, files = next_page, next_files
+                step *= 2
+                continue
+            if next_files:
+                return next_page, next_files
+            break
+        # 最后一个非空页面在(page, next_page)之间, page已满, next_page为空
+        low, high = page, next_page
+        while high - low > 1:
+            middle = (low + high) // 2
+            middle_files = self.get_files(middle)
+            if middle_files:
+                low, files = middle, middle_files
+                if len(middle_files) < self.perpage:
+                    break
+            else:
+                high = middle
+        return low, files
+
+    def do_check(self):
+        cursor = self.get_cursor() or {}
+        page, files = self.find_last_page(cursor.get("page", 1))
+        self.set_cursor({"page": page})
+        if files:
+            latest_build = files[-1]
             self.update_info("LATEST_VERSION", latest_build["name"])
             self.update_info("BUILD_DATE", latest_build["updated_timestamp"])
             self.update_info("FILE_MD5", latest_build["md5sum"])
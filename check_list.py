@@ -2,113 +2,45 @@
 # encoding: utf-8
 
 import json
+import re
 
-from check_init import UAS, CheckUpdate, SfCheck, SfProjectCheck, H5aiCheck, \
-                       AexCheck, PeCheck, PlingCheck, PeCheckPageCache
+from check_init import UAS, CheckUpdate, GroupCheck, SfCheck, SfProjectCheck, H5aiCheck, \
+                       AexCheck, PeCheck, PlingCheck
 
-PE_PAGE_BS_CACHE = PeCheckPageCache()
+class KernelCheck(GroupCheck):
 
-class Linux44Y(CheckUpdate):
+    """
+    kernel.org首页的releases表格, 每个版本系列对应一个项目
+    key为版本系列, 如"4.4"对应4.4.y的最新版本, "5.6-rc"对应5.6的最新rc版本
+    """
 
-    fullname = "Linux Kernel stable v4.4.y"
+    enable_fingerprint = True
 
-    def do_check(self):
-        url = "https://www.kernel.org"
-        bs_obj = self.get_bs(self.request_url(url))
-        for tr_obj in bs_obj.find("table", {"id": "releases"}).find_all("tr"):
-            kernel_version = tr_obj.find_all("td")[1].get_text()
-            if kernel_version.startswith("4.4."):
-                self.update_info("LATEST_VERSION", kernel_version)
-                self.update_info(
-                    "DOWNLOAD_LINK",
-                    "https://git.kernel.org/stable/h/v%s" % kernel_version
-                )
-                self.update_info(
-                    "BUILD_CHANGELOG",
-                    "https://git.kernel.org/pub/scm/linux/kernel/git/stable/linux.git/log/?h=v%s" % kernel_version
-                )
-                break
-        else:
-            raise Exception("Parsing failed!")
-
-    def get_print_text(self):
-        return "*Linux Kernel stable* %s *update*\n\n%s" % (
-            "[v%s](%s)" % (self.info_dic["LATEST_VERSION"], self.info_dic["DOWNLOAD_LINK"]),
-            "[Commits](%s)" % self.info_dic["BUILD_CHANGELOG"]
-        )
-
-class Linux414Y(CheckUpdate):
-
-    fullname = "Linux Kernel stable v4.14.y"
-
-    def do_check(self):
-        url = "https://www.kernel.org"
-        bs_obj = self.get_bs(self.request_url(url))
-        for tr_obj in bs_obj.find("table", {"id": "releases"}).find_all("tr"):
-            kernel_version = tr_obj.find_all("td")[1].get_text()
-            if kernel_version.startswith("4.14."):
-                self.update_info("LATEST_VERSION", kernel_version)
-                self.update_info(
-                    "DOWNLOAD_LINK",
-                    "https://git.kernel.org/stable/h/v%s" % kernel_version
-                )
-                self.update_info(
-                    "BUILD_CHANGELOG",
-                    "https://git.kernel.org/pub/scm/linux/kernel/git/stable/linux.git/log/?h=v%s" % kernel_version
-                )
-                break
-        else:
-            raise Exception("Parsing failed!")
+    def get_source_text(self):
+        return self.request_url("https://www.kernel.org")
 
-class Linux55Y(CheckUpdate):
-
-    fullname = "Linux Kernel stable v5.5.y"
-
-    def do_check(self):
-        url = "https://www.kernel.org"
-        bs_obj = self.get_bs(self.request_url(url))
+    @classmethod
+    def parse_source(cls, source_text):
+        bs_obj = cls.get_bs(source_text, parse_only=("table", {"id": "releases"}))
+        results = {}
         for tr_obj in bs_obj.find("table", {"id": "releases"}).find_all("tr"):
             kernel_version = tr_obj.find_all("td")[1].get_text()
-            if kernel_version.startswith("5.5."):
-                self.update_info("LATEST_VERSION", kernel_version)
-                self.update_info(
-                    "DOWNLOAD_LINK",
-                    "https://git.kernel.org/stable/h/v%s" % kernel_version
-                )
-                self.update_info(
-                    "BUILD_CHANGELOG",
-                    "https://git.kernel.org/pub/scm/linux/kernel/git/stable/linux.git/log/?h=v%s" % kernel_version
-                )
-                break
-        else:
-            raise Exception("Parsing failed!")
-
-
-class Linux56Y(CheckUpdate):
-
-    fullname = "Linux Kernel rc v5.6-rc"
-
-    def do_check(self):
-        url = "https://www.kernel.org"
-        bs_obj = self.get_bs(self.request_url(url))
-        for tr_obj in bs_obj.find("table", {"id": "releases"}).find_all("tr"):
-            kernel_version = tr_obj.find_all("td")[1].get_text()
-            if kernel_version.startswith("5.6-"):
-                self.update_info("LATEST_VERSION", kernel_version)
-                self.update_info(
-                    "DOWNLOAD_LINK",
-                    "https://git.kernel.org/pub/scm/linux/kernel/git/torvalds/linux.git/tree/?h=v%s" % kernel_version
-                )
-                self.update_info(
-                    "BUILD_CHANGELOG",
-                    "https://git.kernel.org/pub/scm/linux/kernel/git/stable/linux-stable-rc.git/log/?h=v%s" % kernel_version
-                )
-                break
-        else:
-            raise Exception("Parsing failed!")
-
-
-
+            match = re.match(r"^(\d+\.\d+)(\.\d+|-rc\d+)$", kernel_version)
+            if match is None:
+                continue
+            if match.group(2).startswith("-rc"):
+                results.setdefault(match.group(1) + "-rc", {
+                    "LATEST_VERSION": kernel_version,
+                    "DOWNLOAD_LINK": "https://git.kernel.org/pub/scm/linux/kernel/git/torvalds/linux.git/tree/?h=v%s" % kernel_version,
+                    "BUILD_CHANGELOG": "https://git.kernel.org/pub/scm/linux/kernel/git/stable/linux-stable-rc.git/log/?h=v%s" % kernel_version,
+                })
+            else:
+                results.setdefault(match.group(1), {
+                    "LATEST_VERSION": kernel_version,
+                    "DOWNLOAD_LINK": "https://git.kernel.org/stable/h/v%s" % kernel_version,
+                    "BUILD_CHANGELOG": "https://git.kernel.org/pub/scm/linux/kernel/git/stable/linux.git/log/?h=v%s" % kernel_version,
+                })
+        return results
 
     def get_print_text(self):
         return "*Linux Kernel stable* %s *update*\n\n%s" % (
@@ -116,6 +48,15 @@ class Linux56Y(CheckUpdate):
             "[Commits](%s)" % self.info_dic["BUILD_CHANGELOG"]
         )
 
+Linux44Y = KernelCheck.member("Linux44Y", "Linux Kernel stable v4.4.y", "4.4")
+# 这两个项目一直使用默认的推送格式
+Linux414Y = KernelCheck.member(
+    "Linux414Y", "Linux Kernel stable v4.14.y", "4.14", get_print_text=CheckUpdate.get_print_text
+)
+Linux55Y = KernelCheck.member(
+    "Linux55Y", "Linux Kernel stable v5.5.y", "5.5", get_print_text=CheckUpdate.get_print_text
+)
+Linux56Y = KernelCheck.member("Linux56Y", "Linux Kernel rc v5.6-rc", "5.6-rc")
 
 class GoogleClangPrebuilt(CheckUpdate):
 
@@ -123,7 +64,7 @@ class GoogleClangPrebuilt(CheckUpdate):
 
     def do_check(self):
         base_url = "https://android.googlesource.com/platform/prebuilts/clang/host/linux-x86"
-        bs_obj = self.get_bs(self.request_url(base_url + "/+log"))
+        bs_obj = self.get_bs(self.request_url(base_url + "/+log"), parse_only=("ol", {"class": "CommitLog"}))
         commits = bs_obj.find("ol", {"class": "CommitLog"}).find_all("li")
         for commit in commits:
             a_tag = commit.find_all("a")[1]
@@ -146,7 +87,7 @@ class GoogleClangPrebuilt(CheckUpdate):
             raise Exception("Parsing failed!")
 
     def after_check(self):
-        bs_obj_2 = self.get_bs(self.request_url(self.info_dic["BUILD_CHANGELOG"]))
+        bs_obj_2 = self.get_bs(self.request_url(self.info_dic["BUILD_CHANGELOG"]), parse_only=("pre",))
         commit_text = bs_obj_2.find("pre").get_text().splitlines()[2]
         if commit_text[-1] == ".":
             commit_text = commit_text[:-1]
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import threading
+import time
+
+import requests
+
+from config import CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_RESET_TIMEOUT, \
+                   CIRCUIT_BREAKER_MAX_RESET_TIMEOUT
+
+class CircuitOpen(requests.exceptions.RequestException):
+    """ 自定义异常, 当目标主机的熔断器处于打开状态时抛出, 不会真正发出请求 """
+
+class CircuitBreaker:
+
+    """
+    单个主机的熔断器
+    closed: 正常放行请求, 连续失败达到CIRCUIT_BREAKER_THRESHOLD次后转为open
+    open: 拒绝所有请求, 经过reset_timeout秒后转为half-open
+    half-open: 只放行一个探测请求, 成功则转为closed, 失败则重新转为open并将reset_timeout加倍
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold=CIRCUIT_BREAKER_THRESHOLD,
+                 reset_timeout=CIRCUIT_BREAKER_RESET_TIMEOUT,
+                 max_reset_timeout=CIRCUIT_BREAKER_MAX_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.base_reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.reset_timeout = reset_timeout
+        self.__opened_time = 0
+        self.__probing = False
+        self.__lock = threading.Lock()
+
+    def allow(self):
+        """
+        判断是否允许发出请求, half-open状态下只有一个调用者会得到True
+        得到True的调用者必须在请求结束后调用record方法
+        """
+        with self.__lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.__opened_time < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN:
+                if self.__probing:
+                    return False
+                self.__probing = True
+            return True
+
+    def record(self, success):
+        """
+        记录请求结果
+        :param success: True为成功, False为主机故障, None表示结果与主机无关(如代理错误)
+        """
+        with self.__lock:
+            probing, self.__probing = self.__probing, False
+            if success is None:
+                return
+            if success:
+                self.state = self.CLOSED
+                self.failures = 0
+                self.reset_timeout = self.base_reset_timeout
+                return
+            self.failures += 1
+            if probing:
+                self.reset_timeout = min(self.reset_timeout * 2, self.max_reset_timeout)
+            if probing or self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.__opened_time = time.monotonic()
+
+class HostCircuitBreakers:
+
+    """ 为每个主机分别维护一个熔断器 """
+
+    def __init__(self):
+        self.__breakers = {}
+        self.__lock = threading.Lock()
+
+    def get(self, host):
+        """ 返回host对应的熔断器, 首次调用时创建 """
+        with self.__lock:
+            breaker = self.__breakers.get(host)
+            if breaker is None:
+                breaker = self.__breakers[host] = CircuitBreaker()
+            return breaker
+
+    def get_open_hosts(self):
+        """ 返回当前不处于closed状态的主机列表 """
+        with self.__lock:
+            return sorted(
+                host for host, breaker in self.__breakers.items()
+                if breaker.state != CircuitBreaker.CLOSED
+            )
+
+CIRCUIT_BREAKERS = HostCircuitBreakers()
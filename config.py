@@ -10,21 +10,169 @@ DEBUG_ENABLE = False
 # SQLite 数据库文件名
 SQLITE_FILE = "saved.db"
 
+# SQLite 数据库被锁定时的最长等待时间(秒)
+SQLITE_BUSY_TIMEOUT = 30
+
+# 检查结果先暂存在内存中, 在每轮检查结束时批量写入数据库
+# 如果设置为大于0的值, 则距离上次写入超过此时间(秒)时也会写入一次
+SAVED_FLUSH_INTERVAL = 0
+
 # 日志文件名
 LOG_FILE = "log.txt"
 
 # 是否启用日志
 ENABLE_LOGGER = True
 
+# 日志格式: "text" 或 "json"(JSON-lines, 每行一个JSON对象, 包含结构化字段)
+LOG_FORMAT = "text"
+
+# 日志轮转方式: "size" 按文件大小轮转, "time" 按时间轮转
+LOG_ROTATE_WHEN = "size"
+
+# 按大小轮转时, 单个日志文件的最大字节数
+LOG_MAX_BYTES = 10 * 1024 * 1024
+
+# 按时间轮转时的轮转周期(TimedRotatingFileHandler的when参数)
+LOG_ROTATE_INTERVAL = "midnight"
+
+# 保留的旧日志文件数量
+LOG_BACKUP_COUNT = 5
+
+# 是否用gzip压缩轮转后的旧日志文件
+LOG_COMPRESS = True
+
+# 指标(metrics)HTTP服务的监听地址和端口, 提供 /metrics (Prometheus格式) 和 /metrics.json
+# 只在循环检查模式(--auto)下启动, 端口设置为0则不启动
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+
+# 守护进程模式(--daemon)下本地控制接口的监听地址和端口
+# 控制接口没有身份验证, 请不要监听外部地址
+CONTROL_HOST = "127.0.0.1"
+CONTROL_PORT = 9109
+
+# 是否通过数据库中的租约在多个进程之间分配检查项目
+# 启用后可以同时运行多个共享同一个数据库文件的 --auto/--daemon 进程, 每个项目的每次到期只会被一个进程检查,
+# 清理数据库和发送消息只由一个进程执行
+# 注意: SQLite的WAL模式不支持网络文件系统, 这些进程需要运行在同一台主机上
+ENABLE_WORK_LEASES = False
+
+# 租约的有效时间(秒), 持有租约的进程退出后, 其他进程最多等待这么久接手它的项目
+# 进程会在后台每隔LEASE_TTL/3秒续期一次, 因此一轮检查的耗时可以超过此时间
+LEASE_TTL = 10 * 60
+
+# 每轮检查最多取得多少个项目的租约(0为不限制), 其余到期的项目留给其他进程, 本进程在下一轮再尝试
+LEASE_CLAIM_LIMIT = 32
+
+# 是否启用持久化的HTTP响应缓存(保存在磁盘上, 程序重启后仍然有效)
+# 主要用于开发时反复运行 -c 以及守护进程重启后避免重新请求所有页面, 可以用命令行参数 --no-cache 绕过
+ENABLE_DISK_CACHE = False
+
+# HTTP响应缓存的SQLite数据库文件名
+DISK_CACHE_FILE = "http_cache.db"
+
+# 缓存的有效时间(秒)
+DISK_CACHE_TTL = 10 * 60
+
+# 为特定主机单独设置缓存的有效时间 {主机名: 秒}, 设置为0则不缓存该主机的响应
+DISK_CACHE_HOST_TTL = {
+    "api.telegram.org": 0,
+}
+
+# 缓存的最大总大小(字节), 超过后淘汰最久没有使用的响应
+DISK_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# 是否在发现更新后下载文件校验哈希值(只对enable_file_verify为True的项目生效, 如SfCheck)
+# 文件以流式方式下载, 内存占用只与VERIFY_CHUNK_SIZE有关, 但会消耗与文件大小相同的流量
+# 哈希值不一致时不会保存和推送这次更新, 下一轮检查时重试
+ENABLE_FILE_VERIFY = False
+
+# 校验文件时每次读取的字节数
+VERIFY_CHUNK_SIZE = 1024 * 1024
+
+# 下载中断时最多通过Range请求续传的次数
+VERIFY_MAX_RESUMES = 5
+
 # 循环检查的间隔时间(默认: 180分钟)
 LOOP_CHECK_INTERVAL = 180 * 60
 
+# 是否启用多线程并发检查
+ENABLE_MULTI_THREAD = False
+
+# 并发检查时的最大线程数
+MAX_THREADS_NUM = 4
+
+# 是否启用每轮检查内的请求缓存(同一轮检查中相同的请求只会发出一次)
+ENABLE_CYCLE_CACHE = True
+
+# 是否启用自适应检查间隔
+# 启用后每个项目的检查间隔会根据其更新历史在下面的上下限之间调整, 否则都按LOOP_CHECK_INTERVAL检查
+ENABLE_ADAPTIVE_SCHEDULE = True
+
+# 自适应检查间隔的下限与上限(秒)
+SCHEDULE_MIN_INTERVAL = 30 * 60
+SCHEDULE_MAX_INTERVAL = 24 * 60 * 60
+
+# 在预计的更新间隔内检查几次
+SCHEDULE_CHECKS_PER_UPDATE = 4
+
+# 根据最近几次更新计算更新间隔
+SCHEDULE_HISTORY_SIZE = 8
+
+# 检查间隔的随机抖动比例(0.1表示±10%), 避免大量项目总在同一时刻检查
+SCHEDULE_JITTER = 0.1
+
+# 在此时间(秒)内即将到期的项目会提前合并到同一轮检查中
+SCHEDULE_BATCH_WINDOW = 5 * 60
+
+# 每个主机的请求速率限制(令牌桶): (每秒补充的请求数, 最多可连续发出的请求数)
+RATE_LIMIT_DEFAULT = (1, 4)
+
+# 为特定主机单独设置请求速率限制 {主机名: (每秒补充的请求数, 最多可连续发出的请求数)}
+RATE_LIMIT_HOSTS = {
+    "sourceforge.net": (0.5, 2),
+}
+
+# 请求失败后的重试次数, 按失败原因分别设置
+# timeout: 读取超时, proxy: 代理错误, connection: 连接错误, status: 服务器返回RETRY_STATUS_CODES中的状态码
+RETRY_TIMES = {
+    "timeout": 1,
+    "proxy": 2,
+    "connection": 2,
+    "status": 2,
+}
+
+# 需要重试的HTTP状态码
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# 重试等待时间(秒): 第n次重试前等待 min(RETRY_BACKOFF_BASE * 2^n, RETRY_BACKOFF_MAX), 并加入随机抖动
+RETRY_BACKOFF_BASE = 2
+RETRY_BACKOFF_MAX = 60
+
+# 同一主机连续失败多少次后熔断(在一段时间内直接判定请求失败, 不再访问该主机)
+CIRCUIT_BREAKER_THRESHOLD = 5
+
+# 熔断后经过多少秒再尝试访问该主机, 探测失败时加倍, 最多加倍到CIRCUIT_BREAKER_MAX_RESET_TIMEOUT
+CIRCUIT_BREAKER_RESET_TIMEOUT = 10 * 60
+CIRCUIT_BREAKER_MAX_RESET_TIMEOUT = 6 * 60 * 60
+
 # 代理服务器
 PROXIES = "127.0.0.1:1080"
 
 # 请求超时
 TIMEOUT = 20
 
+# HTTP连接池的数量(每个主机占用一个连接池)
+POOL_CONNECTIONS = 32
+
+# 每个连接池保持的最大连接数
+POOL_MAXSIZE = 8
+
+# 为特定主机单独设置连接池大小 {主机名: 最大连接数}
+HOST_POOL_MAXSIZE = {
+    "sourceforge.net": 16,
+}
+
 # 是否为 Socks5 代理
 IS_SOCKS = False
 
@@ -37,6 +185,16 @@ TG_TOKEN = os.environ.get("TG_TOKEN", "")
 # 发送消息到...
 TG_SENDTO = os.environ.get("TG_SENDTO", "")
 
+# 每个聊天的消息发送速率限制: (每秒补充的消息数, 最多可连续发送的消息数)
+# Telegram 限制群组和频道每分钟最多20条消息
+TG_RATE_LIMIT = (20 / 60, 3)
+
+# 发件箱后台线程检查待发送消息的间隔(秒)
+OUTBOX_POLL_INTERVAL = 60
+
+# 消息发送失败的最大尝试次数, 超过后丢弃该消息
+OUTBOX_MAX_ATTEMPTS = 10
+
 if IS_SOCKS:
     _PROXIES_DIC = {"http": "socks5h://%s" % PROXIES, "https": "socks5h://%s" % PROXIES}
 else:
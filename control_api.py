@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import json
+import threading
+import time
+from urllib.parse import urlsplit, parse_qs
+
+from database import Saved
+
+class CheckResults:
+
+    """ 记录每个项目最近一次检查的结果和检查轮次, 供控制接口查询和等待 """
+
+    def __init__(self):
+        self.__condition = threading.Condition()
+        self.__results = {}
+        self.__round_start_time = None
+        self.__finished_round_start_time = 0
+
+    def record(self, name, **result):
+        """ 记录name最近一次检查的结果, 如outcome, duration """
+        with self.__condition:
+            self.__results[name] = dict(result, time=time.time())
+
+    def get(self, name):
+        """ 返回name最近一次检查的结果, 没有检查过时返回None """
+        with self.__condition:
+            return self.__results.get(name)
+
+    def start_round(self):
+        """ 一轮检查开始时调用 """
+        with self.__condition:
+            self.__round_start_time = time.time()
+
+    def end_round(self):
+        """ 一轮检查结束(数据已写入数据库)时调用, 唤醒等待结果的调用者 """
+        with self.__condition:
+            self.__finished_round_start_time = self.__round_start_time
+            self.__round_start_time = None
+            self.__condition.notify_all()
+
+    @property
+    def running(self):
+        """ 是否正在进行一轮检查 """
+        with self.__condition:
+            return self.__round_start_time is not None
+
+    def wait_round(self, since, timeout=None):
+        """
+        等待一轮在since之后开始的检查结束
+        :return: 是否等到了, 超时返回False
+        """
+        with self.__condition:
+            return self.__condition.wait_for(lambda: self.__finished_round_start_time >= since, timeout)
+
+CHECK_RESULTS = CheckResults()
+
+def _get_item_info(cls, due_times):
+    saved_info = Saved.get_saved_info(cls.__name__)
+    return {
+        "name": cls.__name__,
+        "due_time": due_times.get(cls),
+        "last_result": CHECK_RESULTS.get(cls.__name__),
+        "saved": saved_info.get_kv() if saved_info is not None else None,
+    }
+
+class ControlAPI:
+
+    """
+    守护进程的本地控制接口, 请求都由运行检查循环的进程处理, 因此可以复用其中的连接池 缓存和数据库连接
+    接口没有身份验证, 只应监听本机地址
+        GET  /status                   调度状态
+        GET  /items                    所有项目的下次检查时间 最近一次检查结果和已保存的数据
+        GET  /items/<name>             单个项目的上述信息
+        POST /check?items=A,B[&wait=N] 立即检查项目(暂停时也会检查), wait不为0时最多等待N秒并返回检查结果
+        POST /pause                    暂停调度
+        POST /resume                   恢复调度
+    """
+
+    def __init__(self, scheduler, cls_list, get_stats_texts=None):
+        """
+        :param scheduler: Scheduler对象
+        :param cls_list: 所有CheckUpdate子类的列表
+        :param get_stats_texts: 返回统计信息文本列表的函数, 显示在/status中
+        """
+        self.scheduler = scheduler
+        self.cls_dic = {cls.__name__: cls for cls in cls_list}
+        self.get_stats_texts = get_stats_texts or (lambda: [])
+
+    def get_status(self):
+        next_due_time = self.scheduler.next_due_time()
+        return {
+            "paused": self.scheduler.paused,
+            "running": CHECK_RESULTS.running,
+            "items": len(self.cls_dic),
+            "next_due_time": None if self.scheduler.paused else next_due_time,
+            "stats": self.get_stats_texts(),
+        }
+
+    def check(self, names, wait=0):
+        unknown = [x for x in names if x not in self.cls_dic]
+        if unknown or not names:
+            return 404, {"error": "Unknown items: %s" % ", ".join(unknown) if unknown else "No items"}
+        request_time = time.time()
+        self.scheduler.check_now([self.cls_dic[x] for x in names])
+        if not wait:
+            return 202, {"accepted": names}
+        if not CHECK_RESULTS.wait_round(request_time, wait):
+            return 504, {"error": "Timeout", "accepted": names}
+        due_times = self.scheduler.get_due_times()
+        return 200, {"items": [_get_item_info(self.cls_dic[x], due_times) for x in names]}
+
+    def handle(self, method, url):
+        """
+        处理一个请求
+        :return: (HTTP状态码, 可以转换为JSON的对象)
+        """
+        parts = urlsplit(url)
+        path = parts.path.rstrip("/")
+        query = parse_qs(parts.query)
+        if method == "GET" and path == "/status":
+            return 200, self.get_status()
+        if method == "GET" and path == "/items":
+            due_times = self.scheduler.get_due_times()
+            return 200, {"items": [_get_item_info(cls, due_times) for cls in self.cls_dic.values()]}
+        if method == "GET" and path.startswith("/items/"):
+            cls = self.cls_dic.get(path[len("/items/"):])
+            if cls is None:
+                return 404, {"error": "Unknown item"}
+            return 200, _get_item_info(cls, self.scheduler.get_due_times())
+        if method == "POST" and path == "/check":
+            names = [x for x in ",".join(query.get("items", [])).split(",") if x]
+            return self.check(names, float(query.get("wait", ["0"])[0]))
+        if method == "POST" and path == "/pause":
+            self.scheduler.pause()
+            return 200, {"paused": True}
+        if method == "POST" and path == "/resume":
+            self.scheduler.resume()
+            return 200, {"paused": False}
+        return 404, {"error": "Not found"}
+
+def start_control_server(host, port, control_api):
+    """
+    在后台线程中启动控制接口的HTTP服务
+    :param control_api: ControlAPI对象
+    :return: ThreadingHTTPServer对象
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class ControlHandler(BaseHTTPRequestHandler):
+
+        def __respond(self, method):
+            try:
+                status_code, data = control_api.handle(method, self.path)
+            except ValueError as error:
+                status_code, data = 400, {"error": str(error)}
+            body = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+            self.send_response(status_code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.__respond("GET")
+
+        def do_POST(self):
+            self.__respond("POST")
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), ControlHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="ControlServer", daemon=True).start()
+    return server
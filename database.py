@@ -2,17 +2,140 @@
 # encoding: utf-8
 
 from collections import OrderedDict
+from concurrent.futures import Future
+import atexit
+import json
+import queue
+import sqlite3
+import threading
+import time
 
-from sqlalchemy import create_engine, Column, String
+from sqlalchemy import create_engine, event, Column, Float, Integer, String
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, exc
+from sqlalchemy.orm import sessionmaker
 
-from config import SQLITE_FILE
+from config import SQLITE_FILE, SAVED_FLUSH_INTERVAL, SQLITE_BUSY_TIMEOUT, SCHEDULE_HISTORY_SIZE
+from logger import write_log_warning
+
+# 每个连接建立时执行的PRAGMA
+# WAL模式下读操作不会被写操作阻塞, synchronous=NORMAL在WAL模式下仍然可以保证数据库不会损坏
+_SQLITE_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "cache_size=-16000",
+    "temp_store=MEMORY",
+    "busy_timeout=%d" % (SQLITE_BUSY_TIMEOUT * 1000),
+)
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in _SQLITE_PRAGMAS:
+            cursor.execute("PRAGMA %s" % pragma)
+    finally:
+        cursor.close()
+
+def create_db_engine(sqlite_file):
+    """
+    创建SQLite数据库引擎, 每个连接都会设置_SQLITE_PRAGMAS
+    :param sqlite_file: 数据库文件名
+    :return: sqlalchemy Engine对象
+    """
+    engine = create_engine(
+        "sqlite:///%s" % sqlite_file,
+        connect_args={"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT},
+    )
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    return engine
+
+class DBWriter:
+
+    """
+    单线程写入器, 所有写操作都放入队列, 由一个后台线程依次执行
+    SQLite同一时间只允许一个写事务, 集中到一个线程写入可以避免"database is locked"错误
+    队列中同时积压的多个写操作会合并到一个事务中提交, 如果合并的事务失败, 则逐个重新执行以隔离出错的操作
+    """
+
+    MAX_BATCH = 64
+
+    def __init__(self, session_factory):
+        self.__session_factory = session_factory
+        self.__queue = queue.Queue()
+        self.__thread = None
+        self.__lock = threading.Lock()
+
+    def __start(self):
+        with self.__lock:
+            if self.__thread is None or not self.__thread.is_alive():
+                self.__thread = threading.Thread(target=self.__run, name="DBWriter", daemon=True)
+                self.__thread.start()
+
+    def __execute(self, jobs):
+        session = self.__session_factory()
+        try:
+            results = [func(session) for func, _ in jobs]
+            session.commit()
+            return results
+        except BaseException:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def __run(self):
+        while True:
+            jobs = [self.__queue.get()]
+            while len(jobs) < self.MAX_BATCH:
+                try:
+                    jobs.append(self.__queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in jobs
+            jobs = [x for x in jobs if x is not None and x[1].set_running_or_notify_cancel()]
+            try:
+                results = self.__execute(jobs)
+            except Exception:
+                for job in jobs:
+                    try:
+                        job[1].set_result(self.__execute([job])[0])
+                    except Exception as error:
+                        job[1].set_exception(error)
+            else:
+                for (_, future), result in zip(jobs, results):
+                    future.set_result(result)
+            if stop:
+                break
+
+    def submit(self, func):
+        """
+        提交一个写操作
+        :param func: 以Session对象为参数的函数, 执行完毕后会自动提交
+        :return: concurrent.futures.Future对象, 可用于等待写入完成并获取func的返回值
+        """
+        future = Future()
+        self.__start()
+        self.__queue.put((func, future))
+        return future
+
+    def execute(self, func):
+        """ 提交一个写操作并等待其完成, 返回func的返回值 """
+        return self.submit(func).result()
+
+    def stop(self):
+        """ 等待队列中已有的写操作全部完成后停止后台线程 """
+        with self.__lock:
+            thread = self.__thread
+        if thread is not None and thread.is_alive():
+            self.__queue.put(None)
+            thread.join()
 
 _Base = declarative_base()
-_Engine = create_engine("sqlite:///%s" % SQLITE_FILE)
-_Base.metadata.create_all(_Engine)
+_Engine = create_db_engine(SQLITE_FILE)
+# 读操作直接使用DBSession, 写操作应通过DB_WRITER提交
 DBSession = sessionmaker(bind=_Engine)
+DB_WRITER = DBWriter(DBSession)
+atexit.register(DB_WRITER.stop)
 
 class Saved(_Base):
 
@@ -44,15 +167,370 @@ class Saved(_Base):
     @classmethod
     def get_saved_info(cls, name):
         """
-        根据name查询并返回数据库中已存储的数据
+        根据name查询并返回已存储的数据(包括尚未写入数据库的数据)
+        数据从SAVED_SNAPSHOT中读取, 不会每次都查询数据库
         如果数据不存在, 则返回None
         :param name: CheckUpdate子类的类名
         :return: Saved对象或None
         """
+        return SAVED_SNAPSHOT.get(name)
+
+class HttpValidator(_Base):
+
+    __tablename__ = "http_validator"
+    ID = Column(String, primary_key=True, nullable=False)
+    URL = Column(String, primary_key=True, nullable=False)
+    ETAG = Column(String)
+    LAST_MODIFIED = Column(String)
+
+    @classmethod
+    def get_validators(cls, name):
+        """
+        返回name对应的检查项目上次保存的全部ETag和Last-Modified(包括尚未写入数据库的数据)
+        数据从SAVED_SNAPSHOT中读取, 不会每次都查询数据库
+        :param name: CheckUpdate子类的类名
+        :return: {url: (etag, last_modified)}
+        """
+        return SAVED_SNAPSHOT.get_validators(name)
+
+class Fingerprint(_Base):
+
+    __tablename__ = "fingerprint"
+    ID = Column(String, primary_key=True, nullable=False)
+    URL = Column(String, primary_key=True, nullable=False)
+    HASH = Column(String, nullable=False)
+
+    @classmethod
+    def get_fingerprints(cls, name):
+        """
+        返回name对应的检查项目上次检查成功时保存的页面指纹(包括尚未写入数据库的数据)
+        数据从SAVED_SNAPSHOT中读取, 不会每次都查询数据库
+        :param name: CheckUpdate子类的类名
+        :return: {url: hash}
+        """
+        return SAVED_SNAPSHOT.get_fingerprints(name)
+
+class Cursor(_Base):
+
+    """ 检查项目的增量检查游标(JSON), 由CheckUpdate.set_cursor设置, 与Saved数据一起写入 """
+
+    __tablename__ = "cursor"
+    ID = Column(String, primary_key=True, nullable=False)
+    VALUE = Column(String, nullable=False)
+
+    @classmethod
+    def get_cursor(cls, name):
+        """
+        返回name对应的检查项目上次检查成功时保存的游标(包括尚未写入数据库的数据)
+        数据从SAVED_SNAPSHOT中读取, 不会每次都查询数据库
+        :param name: CheckUpdate子类的类名
+        :return: 游标(JSON解码之后的对象), 不存在时返回None
+        """
+        value = SAVED_SNAPSHOT.get_cursor(name)
+        return json.loads(value) if value is not None else None
+
+class UpdateHistory(_Base):
+
+    __tablename__ = "update_history"
+    ID = Column(String, primary_key=True, nullable=False)
+    UPDATE_TIME = Column(Float, primary_key=True, nullable=False)
+    LATEST_VERSION = Column(String)
+
+    @classmethod
+    def get_update_times(cls, names):
+        """
+        查询names中每个检查项目最近SCHEDULE_HISTORY_SIZE次检测到更新的时间
+        :param names: CheckUpdate子类的类名列表
+        :return: {name: [时间戳(升序)]}, 没有更新记录的项目不在其中
+        """
         session = DBSession()
         try:
-            return session.query(cls).filter(cls.ID == name).one()
-        except exc.NoResultFound:
-            return None
+            result = {}
+            # 每个项目单独查询, 只读取主键索引中最新的几行, 耗时与表的大小无关
+            for name in set(names):
+                times = [
+                    x.UPDATE_TIME for x in session.query(cls.UPDATE_TIME).filter(
+                        cls.ID == name
+                    ).order_by(cls.UPDATE_TIME.desc()).limit(SCHEDULE_HISTORY_SIZE)
+                ]
+                if times:
+                    result[name] = times[::-1]
+            return result
         finally:
             session.close()
+
+    @classmethod
+    def prune(cls, session, names=None):
+        """
+        删除每个检查项目最近SCHEDULE_HISTORY_SIZE次之前的更新记录, 这些记录不会再被使用
+        :param session: Session对象, 应在DB_WRITER中执行
+        :param names: 需要清理的项目的类名, 为None时清理所有项目
+        """
+        if names is None:
+            names = [x.ID for x in session.query(cls.ID).distinct()]
+        for name in set(names):
+            # 记录不足SCHEDULE_HISTORY_SIZE条时子查询为NULL, 不会删除任何记录
+            oldest_kept = session.query(cls.UPDATE_TIME).filter(cls.ID == name).order_by(
+                cls.UPDATE_TIME.desc()
+            ).offset(SCHEDULE_HISTORY_SIZE - 1).limit(1).scalar_subquery()
+            session.query(cls).filter(
+                cls.ID == name, cls.UPDATE_TIME < oldest_kept
+            ).delete(synchronize_session=False)
+
+class OutboxMessage(_Base):
+
+    __tablename__ = "outbox"
+    ID = Column(Integer, primary_key=True, autoincrement=True)
+    CHAT_ID = Column(String, nullable=False)
+    TEXT = Column(String, nullable=False)
+    CREATE_TIME = Column(Float, nullable=False)
+    ATTEMPTS = Column(Integer, nullable=False, default=0)
+    NEXT_TRY_TIME = Column(Float, nullable=False, default=0)
+
+    @classmethod
+    def get_pending(cls, now):
+        """
+        查询所有已到重试时间的待发送消息
+        :param now: 当前时间戳
+        :return: [(ID, CHAT_ID, TEXT, ATTEMPTS)], 按ID升序
+        """
+        session = DBSession()
+        try:
+            return session.query(cls.ID, cls.CHAT_ID, cls.TEXT, cls.ATTEMPTS).filter(
+                cls.NEXT_TRY_TIME <= now
+            ).order_by(cls.ID).all()
+        finally:
+            session.close()
+
+class Lease(_Base):
+
+    """
+    多个进程共享数据库时, 用于分配检查项目和单一所有者任务的租约
+    ID为检查项目的类名, 或者以"@"开头的任务名(如"@outbox")
+    OWNER在EXPIRE_TIME之前持有该租约, NEXT_DUE_TIME为所有进程共享的下次检查时间
+    """
+
+    __tablename__ = "lease"
+    ID = Column(String, primary_key=True, nullable=False)
+    OWNER = Column(String)
+    EXPIRE_TIME = Column(Float, nullable=False, default=0)
+    NEXT_DUE_TIME = Column(Float, nullable=False, default=0)
+
+    @classmethod
+    def get_next_due_times(cls, names):
+        """
+        查询names中每个检查项目共享的下次检查时间, 被其他进程持有的项目返回租约到期时间与下次检查时间中较晚的一个
+        :param names: CheckUpdate子类的类名列表
+        :return: {name: 时间戳}, 没有记录的项目不在其中
+        """
+        session = DBSession()
+        try:
+            names = set(names)
+            return {
+                x.ID: max(x.NEXT_DUE_TIME, x.EXPIRE_TIME if x.OWNER is not None else 0)
+                for x in session.query(cls).filter(~cls.ID.startswith("@")) if x.ID in names
+            }
+        finally:
+            session.close()
+
+class SavedSnapshot:
+
+    """
+    Saved, HttpValidator, Fingerprint和Cursor表的内存快照, 每轮检查开始时从数据库加载一次, 之后的查询都直接读取内存
+    写入的数据(包括ETag/Last-Modified, 页面指纹和游标)先暂存在内存中,
+    在调用flush方法或距离上次写入超过SAVED_FLUSH_INTERVAL秒时, 在一个事务中批量写入数据库
+    ETag/Last-Modified和页面指纹与Saved数据一起写入, 避免它们先于Saved数据保存而导致更新被跳过
+    """
+
+    def __init__(self):
+        self.__lock = threading.RLock()
+        self.__saved = None
+        # {ID: {URL: (ETAG, LAST_MODIFIED)}}, {ID: {URL: HASH}}, {ID: VALUE}
+        self.__validators = None
+        self.__fingerprints = None
+        self.__cursors = None
+        self.__pending = OrderedDict()
+        self.__new_row_count = 0
+        self.__last_flush_time = time.time()
+        # 写入失败的暂存数据, 由DB_WRITER线程放入, 下次flush时重新写入
+        # 使用单独的锁: DB_WRITER线程不能等待self.__lock, 因为持有它的线程可能正在等待DB_WRITER
+        self.__failed = []
+        self.__failed_lock = threading.Lock()
+
+    def __load(self):
+        session = DBSession()
+        try:
+            self.__saved = {x.ID: x for x in session.query(Saved).all()}
+            self.__validators = {}
+            for x in session.query(HttpValidator).all():
+                self.__validators.setdefault(x.ID, {})[x.URL] = (x.ETAG, x.LAST_MODIFIED)
+            self.__fingerprints = {}
+            for x in session.query(Fingerprint).all():
+                self.__fingerprints.setdefault(x.ID, {})[x.URL] = x.HASH
+            self.__cursors = dict(session.query(Cursor.ID, Cursor.VALUE).all())
+        finally:
+            session.close()
+
+    def __ensure_loaded(self):
+        if self.__saved is None:
+            self.__load()
+
+    def get(self, name):
+        """ 返回name对应的Saved对象, 如果不存在则返回None """
+        with self.__lock:
+            self.__ensure_loaded()
+            return self.__saved.get(name)
+
+    def get_validators(self, name):
+        """ 返回name对应的{url: (etag, last_modified)} """
+        with self.__lock:
+            self.__ensure_loaded()
+            return dict(self.__validators.get(name, {}))
+
+    def get_fingerprints(self, name):
+        """ 返回name对应的{url: hash} """
+        with self.__lock:
+            self.__ensure_loaded()
+            return dict(self.__fingerprints.get(name, {}))
+
+    def get_cursor(self, name):
+        """ 返回name对应的游标(JSON字符串), 如果不存在则返回None """
+        with self.__lock:
+            self.__ensure_loaded()
+            return self.__cursors.get(name)
+
+    def add(self, table, **kwargs):
+        """
+        暂存一行需要写入数据库的数据, 主键相同的数据只保留最后一次
+        :param table: Saved, HttpValidator, Fingerprint, Cursor或UpdateHistory
+        :param kwargs: 该行所有字段的值
+        """
+        key = (table.__tablename__,) + tuple(kwargs[x.name] for x in table.__table__.primary_key)
+        with self.__lock:
+            self.__pending[key] = (table, kwargs)
+            self.__ensure_loaded()
+            if table is Saved:
+                self.__saved[kwargs["ID"]] = Saved(**kwargs)
+            elif table is HttpValidator:
+                self.__validators.setdefault(kwargs["ID"], {})[kwargs["URL"]] = (
+                    kwargs["ETAG"], kwargs["LAST_MODIFIED"]
+                )
+            elif table is Fingerprint:
+                self.__fingerprints.setdefault(kwargs["ID"], {})[kwargs["URL"]] = kwargs["HASH"]
+            elif table is Cursor:
+                self.__cursors[kwargs["ID"]] = kwargs["VALUE"]
+            if SAVED_FLUSH_INTERVAL and time.time() - self.__last_flush_time >= SAVED_FLUSH_INTERVAL:
+                self.flush(wait=False)
+
+    def add_new(self, table, **kwargs):
+        """
+        暂存一行主键由数据库生成的新数据(如OutboxMessage), 不会与其他数据合并
+        与Saved数据在同一个事务中写入, 因此不会出现只写入了其中一部分的情况
+        :param table: 主键为自增整数的表
+        :param kwargs: 除主键之外所有字段的值
+        """
+        with self.__lock:
+            self.__new_row_count += 1
+            self.__pending[(table.__tablename__, None, self.__new_row_count)] = (table, kwargs)
+
+    def __requeue_failed(self):
+        with self.__failed_lock:
+            failed, self.__failed = self.__failed, []
+        if not failed:
+            return
+        # 按写入的顺序合并, 主键相同时保留较新的数据(写入失败之后又暂存的数据最新)
+        merged = OrderedDict()
+        for pending in failed + [self.__pending]:
+            merged.update(pending)
+        self.__pending = merged
+
+    def __on_write_done(self, future, pending):
+        error = future.exception()
+        if error is None:
+            return
+        write_log_warning(
+            "Failed to write %d pending rows to the database, will retry: %r" % (len(pending), error)
+        )
+        with self.__failed_lock:
+            self.__failed.append(pending)
+
+    def discard(self, ids):
+        """ 从快照和暂存数据中删除ids中的项目, 用于数据库清理之后 """
+        with self.__lock:
+            self.__requeue_failed()
+            for key in [x for x in self.__pending if x[1] in ids]:
+                del self.__pending[key]
+            if self.__saved is not None:
+                for id_ in ids:
+                    for rows in (self.__saved, self.__validators, self.__fingerprints, self.__cursors):
+                        rows.pop(id_, None)
+
+    def flush(self, wait=True):
+        """
+        将暂存的数据在一个事务中批量写入数据库(INSERT OR REPLACE)
+        写入失败(如数据库被锁定 磁盘已满)时记录警告, 这些数据会在下次flush时重新写入
+        :param wait: 是否等待写入完成, 等待时写入失败的异常会抛出给调用者
+        """
+        with self.__lock:
+            self.__last_flush_time = time.time()
+            self.__requeue_failed()
+            if not self.__pending:
+                return
+            pending = self.__pending
+            self.__pending = OrderedDict()
+            rows_by_table = OrderedDict()
+            for table, kwargs in pending.values():
+                rows_by_table.setdefault(table, []).append(kwargs)
+
+            def write(session):
+                for table, rows in rows_by_table.items():
+                    session.execute(table.__table__.insert().prefix_with("OR REPLACE"), rows)
+                if UpdateHistory in rows_by_table:
+                    UpdateHistory.prune(session, [x["ID"] for x in rows_by_table[UpdateHistory]])
+
+            future = DB_WRITER.submit(write)
+        future.add_done_callback(lambda x: self.__on_write_done(x, pending))
+        if wait:
+            future.result()
+
+    def reload(self):
+        """ 写入暂存的数据, 并在下次查询时重新从数据库加载快照, 应在每轮检查开始时调用 """
+        with self.__lock:
+            self.flush()
+            self.__saved = None
+
+SAVED_SNAPSHOT = SavedSnapshot()
+
+def _create_tables():
+    # 多个进程同时启动时, 其他进程可能在检查表是否存在之后 创建之前建好了某个表, 此时重新检查即可
+    # 每次重试至少有一个表已经建好, 因此最多重试表的数量次
+    for _ in range(len(_Base.metadata.tables)):
+        try:
+            _Base.metadata.create_all(_Engine)
+            return
+        except OperationalError:
+            time.sleep(0.1)
+    _Base.metadata.create_all(_Engine)
+
+_create_tables()
+
+def use_database_copy(sqlite_file):
+    """
+    将SQLITE_FILE复制到sqlite_file, 之后所有的读写都改为使用这个副本, 用于回放等不应修改正式数据库的场景
+    应在进行任何数据库操作之前调用
+    :param sqlite_file: 副本的文件名, 已存在时会被覆盖
+    """
+    global _Engine
+    # 使用SQLite的备份接口复制, WAL文件中尚未合并的数据也会被复制
+    source = sqlite3.connect(SQLITE_FILE)
+    target = sqlite3.connect(sqlite_file)
+    try:
+        source.backup(target)
+    finally:
+        source.close()
+        target.close()
+    _Engine = create_db_engine(sqlite_file)
+    DBSession.configure(bind=_Engine)
+    SAVED_SNAPSHOT.reload()
+    _create_tables()
+
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import hashlib
+import threading
+import time
+from urllib.parse import urlsplit
+
+from sqlalchemy import Column, Float, Index, Integer, MetaData, String, Table, Text, func, select
+
+from config import ENABLE_DISK_CACHE, DISK_CACHE_FILE, DISK_CACHE_TTL, DISK_CACHE_HOST_TTL, \
+                   DISK_CACHE_MAX_BYTES
+from database import create_db_engine
+
+_METADATA = MetaData()
+
+_CACHE_TABLE = Table(
+    "http_cache", _METADATA,
+    Column("KEY", String, primary_key=True, nullable=False),
+    Column("URL", String, nullable=False),
+    Column("STATUS_CODE", Integer, nullable=False),
+    Column("TEXT", Text, nullable=False),
+    Column("ETAG", String),
+    Column("LAST_MODIFIED", String),
+    Column("STORE_TIME", Float, nullable=False),
+    Column("ACCESS_TIME", Float, nullable=False),
+    Column("SIZE", Integer, nullable=False),
+    Index("ix_http_cache_access_time", "ACCESS_TIME"),
+)
+
+class DiskCache:
+
+    """
+    持久化的HTTP响应缓存, 保存在单独的SQLite数据库文件(DISK_CACHE_FILE)中, 程序重启后仍然有效
+    缓存的有效时间按主机设置(DISK_CACHE_HOST_TTL, 默认为DISK_CACHE_TTL), 有效时间为0的主机不缓存
+    缓存的总大小超过DISK_CACHE_MAX_BYTES时, 按最近访问时间淘汰最久没有使用的响应
+    数据库使用WAL模式, 多个线程和进程可以同时读取
+    """
+
+    def __init__(self, sqlite_file=DISK_CACHE_FILE, ttl=DISK_CACHE_TTL, host_ttl=None,
+                 max_bytes=DISK_CACHE_MAX_BYTES, enabled=ENABLE_DISK_CACHE):
+        self.sqlite_file = sqlite_file
+        self.ttl = ttl
+        self.host_ttl = DISK_CACHE_HOST_TTL if host_ttl is None else host_ttl
+        self.max_bytes = max_bytes
+        # 设置为False即可绕过缓存(既不读取也不写入)
+        self.enabled = enabled
+        self.__engine = None
+        self.__lock = threading.Lock()
+
+    def __get_engine(self):
+        # 第一次使用时才创建数据库, 没有启用缓存时不会产生任何开销
+        if self.__engine is None:
+            with self.__lock:
+                if self.__engine is None:
+                    engine = create_db_engine(self.sqlite_file)
+                    _METADATA.create_all(engine)
+                    self.__engine = engine
+        return self.__engine
+
+    def get_ttl(self, url):
+        """ 返回url所在主机的缓存有效时间(秒) """
+        return self.host_ttl.get(urlsplit(url).hostname, self.ttl)
+
+    @staticmethod
+    def _hash_key(request_key):
+        return hashlib.sha1(repr(request_key).encode("utf-8")).hexdigest()
+
+    def get(self, request_key, url, now=None):
+        """
+        查询缓存的响应
+        :param request_key: http_cache.make_request_key生成的key
+        :param url: 请求的url, 用于确定缓存有效时间
+        :param now: 当前时间戳, 默认为time.time()
+        :return: 没有过期的响应(status_code, text, etag, last_modified), 不存在或已过期时返回None
+        """
+        ttl = self.get_ttl(url)
+        if not self.enabled or ttl <= 0:
+            return None
+        if now is None:
+            now = time.time()
+        key = self._hash_key(request_key)
+        with self.__get_engine().begin() as connection:
+            row = connection.execute(
+                select(
+                    _CACHE_TABLE.c.STATUS_CODE, _CACHE_TABLE.c.TEXT, _CACHE_TABLE.c.ETAG,
+                    _CACHE_TABLE.c.LAST_MODIFIED, _CACHE_TABLE.c.STORE_TIME,
+                ).where(_CACHE_TABLE.c.KEY == key)
+            ).first()
+            if row is None or now - row.STORE_TIME >= ttl:
+                return None
+            connection.execute(
+                _CACHE_TABLE.update().where(_CACHE_TABLE.c.KEY == key).values(ACCESS_TIME=now)
+            )
+        return row.STATUS_CODE, row.TEXT, row.ETAG, row.LAST_MODIFIED
+
+    def put(self, request_key, url, response, now=None):
+        """
+        保存响应, 保存之后如果缓存的总大小超过max_bytes, 则淘汰最久没有使用的响应
+        :param request_key: http_cache.make_request_key生成的key
+        :param url: 请求的url
+        :param response: (status_code, text, etag, last_modified)
+        :param now: 当前时间戳, 默认为time.time()
+        """
+        if not self.enabled or self.get_ttl(url) <= 0:
+            return
+        if now is None:
+            now = time.time()
+        status_code, text, etag, last_modified = response
+        size = len(text.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self.__get_engine().begin() as connection:
+            connection.execute(_CACHE_TABLE.insert().prefix_with("OR REPLACE"), {
+                "KEY": self._hash_key(request_key), "URL": url, "STATUS_CODE": status_code,
+                "TEXT": text, "ETAG": etag, "LAST_MODIFIED": last_modified,
+                "STORE_TIME": now, "ACCESS_TIME": now, "SIZE": size,
+            })
+            self.__evict(connection)
+
+    def __evict(self, connection):
+        total_size = connection.execute(select(func.sum(_CACHE_TABLE.c.SIZE))).scalar() or 0
+        if total_size <= self.max_bytes:
+            return
+        # 一次淘汰到max_bytes的90%, 避免之后的每次写入都要淘汰
+        cutoff_time = None
+        for access_time, size in connection.execute(
+            select(_CACHE_TABLE.c.ACCESS_TIME, _CACHE_TABLE.c.SIZE).order_by(_CACHE_TABLE.c.ACCESS_TIME)
+        ):
+            total_size -= size
+            cutoff_time = access_time
+            if total_size <= self.max_bytes * 0.9:
+                break
+        connection.execute(_CACHE_TABLE.delete().where(_CACHE_TABLE.c.ACCESS_TIME <= cutoff_time))
+
+DISK_CACHE = DiskCache()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import hashlib
+import os
+import re
+from urllib.parse import unquote, urlsplit
+
+import requests
+
+import http_session
+from config import _PROXIES_DIC, TIMEOUT, VERIFY_CHUNK_SIZE, VERIFY_MAX_RESUMES
+
+# info_dic中的哈希字段与hashlib算法名的对应关系
+HASH_KEYS = {
+    "FILE_MD5": "md5",
+    "FILE_SHA1": "sha1",
+    "FILE_SHA256": "sha256",
+}
+
+# 读取响应正文时可能发生的网络错误, 发生这些错误时从已读取的位置继续下载
+_RESUMABLE_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+)
+
+# GNU coreutils格式: "<哈希值>  <文件名>" 或 "<哈希值> *<文件名>"
+_GNU_LINE_RE = re.compile(r"^\\?([0-9a-fA-F]{32,128})\s+\*?(.+)$")
+# BSD格式: "SHA256 (<文件名>) = <哈希值>"
+_BSD_LINE_RE = re.compile(r"^(\w+)\s*\((.+)\)\s*=\s*([0-9a-fA-F]{32,128})$")
+
+class HashMismatch(Exception):
+    """ 自定义异常, 当下载文件的哈希值与检查得到的哈希值不一致时抛出 """
+
+def _get_content_range_start(response):
+    # 例: "bytes 1048576-5242879/5242880"
+    match = re.match(r"bytes\s+(\d+)-", response.headers.get("Content-Range", ""))
+    return int(match.group(1)) if match else None
+
+def hash_url(url, algorithms=tuple(HASH_KEYS.values()), chunk_size=VERIFY_CHUNK_SIZE,
+             max_resumes=VERIFY_MAX_RESUMES, **kwargs):
+    """
+    流式下载url, 同时计算多种哈希值, 内存占用只与chunk_size有关
+    下载中断时通过Range请求从已读取的位置继续(携带If-Range, 文件已变化时服务器会返回完整文件, 此时重新计算)
+    :param url: 要下载的文件的url
+    :param algorithms: hashlib算法名列表
+    :param chunk_size: 每次读取的字节数
+    :param max_resumes: 最多续传的次数
+    :param kwargs: 需要传递给http_session.get方法的参数
+    :return: ({算法名: 十六进制哈希值}, 文件大小)
+    """
+    kwargs.setdefault("timeout", TIMEOUT)
+    kwargs.setdefault("proxies", _PROXIES_DIC)
+    headers = dict(kwargs.pop("headers", {}))
+    hashers = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+    offset = 0
+    total_size = None
+    resumes = 0
+    while True:
+        if offset:
+            headers["Range"] = "bytes=%d-" % offset
+        response = http_session.get(url, stream=True, headers=headers, **kwargs)
+        try:
+            if offset and response.status_code == 206 and _get_content_range_start(response) == offset:
+                pass
+            elif response.status_code == 200:
+                # 第一次请求, 或者服务器不支持Range/文件已变化, 从头开始计算
+                if offset:
+                    hashers = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+                    offset = 0
+                content_length = response.headers.get("Content-Length")
+                total_size = int(content_length) if content_length is not None else None
+                validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+                if validator is not None:
+                    headers["If-Range"] = validator
+            else:
+                response.raise_for_status()
+                raise requests.exceptions.HTTPError(
+                    "Unexpected response to range request: %s" % response.status_code, response=response
+                )
+            try:
+                for chunk in response.iter_content(chunk_size):
+                    for hasher in hashers.values():
+                        hasher.update(chunk)
+                    offset += len(chunk)
+            except _RESUMABLE_ERRORS:
+                if resumes >= max_resumes:
+                    raise
+            else:
+                # Content-Length与实际读取的字节数不一致说明连接被提前关闭
+                if total_size is None or offset >= total_size:
+                    return {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items()}, offset
+                if resumes >= max_resumes:
+                    raise requests.exceptions.ChunkedEncodingError(
+                        "Connection closed after %d of %d bytes: %s" % (offset, total_size, url)
+                    )
+        finally:
+            response.close()
+        resumes += 1
+
+def _parse_manifest_line(line):
+    line = line.strip()
+    match = _GNU_LINE_RE.match(line)
+    if match is not None:
+        return match.group(2), match.group(1)
+    match = _BSD_LINE_RE.match(line)
+    if match is not None:
+        return match.group(2), match.group(3)
+    return None
+
+def find_hash_in_manifest(url, filename, chunk_size=VERIFY_CHUNK_SIZE, **kwargs):
+    """
+    逐行流式扫描校验文件(如SHA256SUMS, 支持GNU和BSD格式), 返回其中filename对应的哈希值
+    只比较文件名部分(忽略目录), 找到后立即停止下载
+    :param url: 校验文件的url
+    :param filename: 要查找的文件名, 也可以传入下载链接
+    :param chunk_size: 每次读取的字节数
+    :param kwargs: 需要传递给http_session.get方法的参数
+    :return: 哈希值字符串(小写), 找不到时返回None
+    """
+    kwargs.setdefault("timeout", TIMEOUT)
+    kwargs.setdefault("proxies", _PROXIES_DIC)
+    filename = os.path.basename(unquote(urlsplit(filename).path))
+    response = http_session.get(url, stream=True, **kwargs)
+    try:
+        response.raise_for_status()
+        for line in response.iter_lines(chunk_size):
+            parsed = _parse_manifest_line(line.decode("utf-8", "replace"))
+            if parsed is not None and os.path.basename(parsed[0].strip()) == filename:
+                return parsed[1].lower()
+    finally:
+        response.close()
+    return None
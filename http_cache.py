@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import threading
+from urllib.parse import urlencode
+
+from config import ENABLE_CYCLE_CACHE
+
+# 这些请求头不会影响页面内容, 生成缓存key时忽略
+_IGNORED_HEADERS = {"user-agent"}
+
+def make_request_key(url, params=None, headers=None, **kwargs):
+    """
+    根据url, 请求参数和会影响页面内容的请求头生成缓存key
+    :param url: 要请求的url
+    :param params: 传递给requests的params参数
+    :param headers: 请求头字典
+    :param kwargs: 其他会影响请求结果的参数(如encoding, verify)
+    :return: 可哈希的元组
+    """
+    if isinstance(params, (dict, list, tuple)):
+        params = urlencode(params, doseq=True)
+    headers = tuple(sorted(
+        (k.lower(), v) for k, v in (headers or {}).items()
+        if k.lower() not in _IGNORED_HEADERS
+    ))
+    return url, params, headers, tuple(sorted((k, repr(v)) for k, v in kwargs.items()))
+
+class _InFlight:
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+class CycleCache:
+
+    """
+    只在一轮检查中有效的缓存, 调用new_cycle方法后全部失效
+    相同key的并发调用会被合并, 只有第一个调用者真正执行, 其余调用者等待并共享其结果
+    执行失败时不缓存, 等待中的调用者会收到同样的异常
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__cycle_id = 0
+        self.__data = {}
+        self.__in_flight = {}
+        self.hits = 0
+        self.misses = 0
+
+    def new_cycle(self):
+        """ 开始新一轮检查, 清空缓存 """
+        with self.__lock:
+            self.__cycle_id += 1
+            self.__data = {}
+            self.__in_flight = {}
+            self.hits = 0
+            self.misses = 0
+
+    def get_or_create(self, key, func):
+        """
+        返回key对应的缓存值, 如果不存在则调用func生成
+        :param key: 可哈希的缓存key
+        :param func: 无参数的函数, 返回需要缓存的值
+        :return: 缓存值
+        """
+        if not ENABLE_CYCLE_CACHE:
+            return func()
+        with self.__lock:
+            if key in self.__data:
+                self.hits += 1
+                return self.__data[key]
+            in_flight = self.__in_flight.get(key)
+            if in_flight is not None:
+                self.hits += 1
+                is_owner = False
+            else:
+                in_flight = self.__in_flight[key] = _InFlight()
+                self.misses += 1
+                cycle_id = self.__cycle_id
+                is_owner = True
+        if not is_owner:
+            in_flight.event.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.value
+        try:
+            in_flight.value = func()
+        except BaseException as error:
+            in_flight.error = error
+            raise
+        finally:
+            with self.__lock:
+                if in_flight.error is None and cycle_id == self.__cycle_id:
+                    self.__data[key] = in_flight.value
+                if self.__in_flight.get(key) is in_flight:
+                    del self.__in_flight[key]
+            in_flight.event.set()
+        return in_flight.value
+
+    def get_stats_text(self):
+        """ 返回缓存命中情况的汇总文本, 用于打印和写入日志 """
+        return "Cycle cache: %d hits, %d misses" % (self.hits, self.misses)
+
+CYCLE_CACHE = CycleCache()
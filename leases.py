@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import os
+import socket
+import threading
+import time
+import uuid
+
+from sqlalchemy import and_, or_
+
+from config import LEASE_TTL, LEASE_CLAIM_LIMIT, SCHEDULE_BATCH_WINDOW
+from database import DB_WRITER, Lease
+from logger import write_log_exception
+
+class WorkLeases:
+
+    """
+    通过数据库中的lease表在多个共享同一个数据库的进程之间分配检查项目
+    每个项目的下次检查时间保存在lease表中, 由所有进程共享, 进程检查一个项目之前必须先取得它的租约,
+    因此同一个到期时间只会有一个进程检查, 检查结束后写入新的下次检查时间并释放租约
+    后台线程定期续期本进程持有的全部租约, 进程退出或卡死后租约在LEASE_TTL秒后过期, 由其他进程接手
+    清理数据库 发送消息等只能由一个进程执行的任务使用以"@"开头的租约(见acquire_role)
+    所有写操作都通过DB_WRITER执行, 每条UPDATE语句都带有完整的判断条件, 因此在多个进程之间也是原子的
+    """
+
+    def __init__(self, owner=None, ttl=LEASE_TTL):
+        self.owner = owner or "%s:%d:%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.ttl = ttl
+        self.__thread = None
+        self.__lock = threading.Lock()
+
+    def __ensure_rows(self, session, ids, now):
+        table = Lease.__table__
+        session.execute(
+            table.insert().prefix_with("OR IGNORE"),
+            [{"ID": id_, "OWNER": None, "EXPIRE_TIME": 0, "NEXT_DUE_TIME": now} for id_ in ids]
+        )
+
+    def __claim_condition(self, now):
+        return or_(Lease.OWNER.is_(None), Lease.OWNER == self.owner, Lease.EXPIRE_TIME < now)
+
+    def claim(self, names, forced=(), limit=LEASE_CLAIM_LIMIT, now=None):
+        """
+        尝试按顺序取得names中各个项目的租约, 最多取得limit个, 其余的项目留给其他进程
+        只有共享的下次检查时间已经到期(或在SCHEDULE_BATCH_WINDOW秒内到期), 并且没有被其他进程持有的项目才能取得
+        :param names: CheckUpdate子类的类名列表
+        :param forced: 要求立即检查的项目, 不判断下次检查时间, 但仍然不能取得其他进程持有的租约
+        :param limit: 最多取得的租约数量, 为0时不限制
+        :param now: 当前时间戳, 默认为time.time()
+        :return: 成功取得租约的类名集合
+        """
+        if not names:
+            return set()
+        if now is None:
+            now = time.time()
+
+        def claim(session):
+            self.__ensure_rows(session, names, now)
+            claimed = set()
+            for name in names:
+                if limit and len(claimed) >= limit:
+                    break
+                condition = and_(Lease.ID == name, self.__claim_condition(now))
+                if name not in forced:
+                    condition = and_(condition, Lease.NEXT_DUE_TIME <= now + SCHEDULE_BATCH_WINDOW)
+                result = session.execute(
+                    Lease.__table__.update().where(condition).values(
+                        OWNER=self.owner, EXPIRE_TIME=now + self.ttl
+                    )
+                )
+                if result.rowcount:
+                    claimed.add(name)
+            return claimed
+
+        return DB_WRITER.execute(claim)
+
+    def release(self, due_times):
+        """
+        写入项目的下次检查时间并释放租约, 租约已被其他进程接手的项目不会被修改
+        :param due_times: {类名: 下次检查时间}
+        """
+        def release(session):
+            for name, due_time in due_times.items():
+                session.execute(
+                    Lease.__table__.update().where(
+                        and_(Lease.ID == name, Lease.OWNER == self.owner)
+                    ).values(OWNER=None, EXPIRE_TIME=0, NEXT_DUE_TIME=due_time)
+                )
+
+        if due_times:
+            DB_WRITER.execute(release)
+
+    def acquire_role(self, role, now=None):
+        """
+        尝试取得(或续期)单一所有者任务的租约, 同一时间只有一个进程能持有
+        持有的租约会由后台线程自动续期, 直到调用release_role或进程退出
+        :param role: 任务名, 如"outbox", "cleanup"
+        :return: 本进程是否持有该租约
+        """
+        if now is None:
+            now = time.time()
+        id_ = "@" + role
+
+        def acquire(session):
+            self.__ensure_rows(session, [id_], now)
+            return session.execute(
+                Lease.__table__.update().where(
+                    and_(Lease.ID == id_, self.__claim_condition(now))
+                ).values(OWNER=self.owner, EXPIRE_TIME=now + self.ttl)
+            ).rowcount > 0
+
+        return DB_WRITER.execute(acquire)
+
+    def release_role(self, role):
+        """ 释放单一所有者任务的租约 """
+        DB_WRITER.execute(
+            lambda session: session.execute(
+                Lease.__table__.update().where(
+                    and_(Lease.ID == "@" + role, Lease.OWNER == self.owner)
+                ).values(OWNER=None, EXPIRE_TIME=0)
+            )
+        )
+
+    def renew(self, now=None):
+        """ 续期本进程持有的全部租约 """
+        if now is None:
+            now = time.time()
+        DB_WRITER.execute(
+            lambda session: session.execute(
+                Lease.__table__.update().where(Lease.OWNER == self.owner).values(
+                    EXPIRE_TIME=now + self.ttl
+                )
+            )
+        )
+
+    def __run(self):
+        while True:
+            time.sleep(self.ttl / 3)
+            try:
+                self.renew()
+            except Exception:
+                write_log_exception("Failed to renew leases!", owner=self.owner)
+
+    def start(self):
+        """ 启动后台续期线程 """
+        with self.__lock:
+            if self.__thread is None or not self.__thread.is_alive():
+                self.__thread = threading.Thread(target=self.__run, name="LeaseRenewer", daemon=True)
+                self.__thread.start()
@@ -1,29 +1,113 @@
 #!/usr/bin/env python3
 # encoding: utf-8
 
+import atexit
+import gzip
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import shutil
 
-from config import LOG_FILE, ENABLE_LOGGER
+from config import LOG_FILE, ENABLE_LOGGER, LOG_FORMAT, LOG_ROTATE_WHEN, LOG_MAX_BYTES, \
+                   LOG_ROTATE_INTERVAL, LOG_BACKUP_COUNT, LOG_COMPRESS
 
 _LOGGER = logging.getLogger(__name__)
 _LOGGER.setLevel(level=logging.INFO)
+_LOGGER.propagate = False
+
+class _TextFormatter(logging.Formatter):
+
+    """ 文本格式, 结构化字段以key=value的形式附加在消息末尾 """
+
+    def formatMessage(self, record):
+        text = super().formatMessage(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            text = "%s [%s]" % (text, " ".join("%s=%s" % (k, v) for k, v in fields.items()))
+        return text
+
+class _JsonFormatter(logging.Formatter):
+
+    """ JSON-lines格式, 每条日志一行JSON, 结构化字段作为顶层键 """
+
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        data.update(getattr(record, "fields", None) or {})
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False)
+
+class _QueueHandler(logging.handlers.QueueHandler):
+
+    """ 只在调用者线程中合并消息参数, 异常信息单独保存, 由后台线程格式化 """
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def _gzip_rotator(source, dest):
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
 
 def _build_handler():
-    handler = logging.FileHandler(LOG_FILE)
+    if LOG_ROTATE_WHEN == "time":
+        handler = logging.handlers.TimedRotatingFileHandler(
+            LOG_FILE, when=LOG_ROTATE_INTERVAL, backupCount=LOG_BACKUP_COUNT, delay=True
+        )
+    else:
+        handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, delay=True
+        )
+    if LOG_COMPRESS:
+        handler.namer = lambda name: name + ".gz"
+        handler.rotator = _gzip_rotator
     handler.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
+    if LOG_FORMAT == "json":
+        handler.setFormatter(_JsonFormatter())
+    else:
+        handler.setFormatter(_TextFormatter('%(asctime)s - %(levelname)s - %(message)s'))
     return handler
 
-_LOGGER.addHandler(_build_handler())
+# 调用者只把日志放入队列, 由QueueListener的后台线程负责格式化 写入文件和轮转压缩
+_LOG_QUEUE = queue.SimpleQueue()
+_LOGGER.addHandler(_QueueHandler(_LOG_QUEUE))
+_LISTENER = logging.handlers.QueueListener(_LOG_QUEUE, _build_handler())
 
 if ENABLE_LOGGER:
-    def write_log_info(*text):
+    _LISTENER.start()
+    atexit.register(_LISTENER.stop)
+    def write_log_info(*text, **fields):
+        """
+        写入INFO日志, 每个字符串作为一条记录
+        :param fields: 结构化字段, 如checker, host, duration, outcome
+        """
         for string in text:
-            _LOGGER.info(string)
-    def write_log_warning(*text):
+            _LOGGER.info(string, extra={"fields": fields})
+    def write_log_warning(*text, **fields):
+        """
+        写入WARNING日志, 每个字符串作为一条记录
+        :param fields: 结构化字段, 如checker, host, duration, outcome
+        """
         for string in text:
-            _LOGGER.warning(string)
+            _LOGGER.warning(string, extra={"fields": fields})
+    def write_log_exception(text, **fields):
+        """
+        写入WARNING日志, 并附带当前正在处理的异常的完整堆栈(作为同一条记录), 只能在except块中调用
+        :param fields: 结构化字段, 如checker, host, duration, outcome
+        """
+        _LOGGER.warning(text, exc_info=True, extra={"fields": fields})
 else:
-    def write_log_info(*text): pass
-    def write_log_warning(*text): pass
+    def write_log_info(*text, **fields): pass
+    def write_log_warning(*text, **fields): pass
+    def write_log_exception(text, **fields): pass
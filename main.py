@@ -2,58 +2,155 @@
 # encoding: utf-8
 
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import tempfile
+import threading
 import time
 import traceback
 import sys
 
 from requests import exceptions
 
-from config import DEBUG_ENABLE, ENABLE_SENDMESSAGE, LOOP_CHECK_INTERVAL
-from check_init import ErrorCode
-from check_list import CHECK_LIST, PE_PAGE_BS_CACHE
-from database import DBSession, Saved
-from tgbot import send_message
-from logger import write_log_info, write_log_warning
+from config import DEBUG_ENABLE, ENABLE_SENDMESSAGE, \
+                   ENABLE_MULTI_THREAD, MAX_THREADS_NUM, METRICS_HOST, METRICS_PORT, \
+                   CONTROL_HOST, CONTROL_PORT, ENABLE_WORK_LEASES, ENABLE_FILE_VERIFY, SQLITE_FILE
+from check_init import ErrorCode, NotModified, ContentUnchanged, HashMismatch
+from check_list import CHECK_LIST
+from cassette import CASSETTE
+from disk_cache import DISK_CACHE
+from database import DB_WRITER, SAVED_SNAPSHOT, Saved, HttpValidator, Fingerprint, Cursor, \
+                     UpdateHistory, Lease, use_database_copy
+from http_cache import CYCLE_CACHE
+from circuit_breaker import CircuitOpen
+from control_api import CHECK_RESULTS, ControlAPI, start_control_server
+from http_session import get_pool_stats_text, is_proxy_reachable
+from leases import WorkLeases
+from scheduler import Scheduler
+from tgbot import OUTBOX, post_message
+from logger import write_log_info, write_log_warning, write_log_exception
+from metrics import METRICS, start_metrics_server
 
 FORCE_UPDATE = False
 DONT_POST = False
 
+# 校验失败的文件 {项目名: _get_download_key的返回值}
+_REJECTED_DOWNLOADS = {}
+
+_PRINT_LOCK = threading.Lock()
+_THREAD_LOCAL = threading.local()
+
 def database_cleanup():
     """
-    将数据库中存在于数据库但不存在于CHECK_LIST的项目删除掉
+    将数据库中存在于数据库但不存在于CHECK_LIST的项目(及其ETag/Last-Modified, 页面指纹, 游标和更新历史记录)删除掉
     :return: 被删除的项目名字的集合
     """
-    session = DBSession()
-    try:
-        saved_ids = {x.ID for x in session.query(Saved).all()}
-        checklist_ids = {x.__name__ for x in CHECK_LIST}
-        drop_ids = saved_ids - checklist_ids
-        for id_ in drop_ids:
-            session.delete(session.query(Saved).filter(Saved.ID == id_).one())
-        session.commit()
+    checklist_ids = {x.__name__ for x in CHECK_LIST}
+    SAVED_SNAPSHOT.flush()
+
+    def cleanup(session):
+        drop_ids = {
+            x.ID for x in session.query(Saved.ID).filter(Saved.ID.notin_(checklist_ids))
+        }
+        for table in (Saved, HttpValidator, Fingerprint, Cursor, UpdateHistory):
+            session.query(table).filter(
+                table.ID.notin_(checklist_ids)
+            ).delete(synchronize_session=False)
+        # 之前的版本没有清理过更新历史, 已经积累的旧记录在这里一并删除
+        UpdateHistory.prune(session)
+        # 以"@"开头的是单一所有者任务的租约, 不属于任何项目
+        session.query(Lease).filter(
+            Lease.ID.notin_(checklist_ids), ~Lease.ID.startswith("@")
+        ).delete(synchronize_session=False)
         return drop_ids
-    finally:
-        session.close()
+
+    drop_ids = DB_WRITER.execute(cleanup)
+    SAVED_SNAPSHOT.discard(drop_ids)
+    return drop_ids
 
 def _abort(text):
     print(" - %s" % text)
     write_log_warning(str(text))
+    SAVED_SNAPSHOT.flush()
     sys.exit(1)
 
 def _abort_by_user():
     return _abort("Abort by user")
 
-def _sleep(sleep_time=0):
-    try:
-        time.sleep(sleep_time)
-    except KeyboardInterrupt:
-        _abort_by_user()
+def _print(*args, end="\n"):
+    """
+    多线程并发检查时, 每个检查项目的输出先写入当前线程的缓冲区
+    检查结束后再一次性打印, 避免不同项目的输出交错在一起
+    """
+    buffer = getattr(_THREAD_LOCAL, "buffer", None)
+    if buffer is None:
+        print(*args, end=end)
+    else:
+        buffer.append(" ".join(str(x) for x in args) + end)
 
 def _get_time_str(time_num=None, offset=0):
     if time_num is None:
         time_num = time.time()
     return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time_num+offset))
 
+def _log_fields(cls_obj, start_time, outcome):
+    """ 返回check_one写入日志的结构化字段, 同时统计并记录该项目的检查结果 """
+    duration = round(time.time() - start_time, 3)
+    METRICS.inc("check_total", checker=cls_obj.name, outcome=outcome)
+    CHECK_RESULTS.record(
+        cls_obj.name, outcome=outcome, duration=duration,
+        latest_version=cls_obj.info_dic["LATEST_VERSION"],
+    )
+    return {
+        "checker": cls_obj.name,
+        "outcome": outcome,
+        "duration": duration,
+    }
+
+def _get_download_key(cls_obj):
+    return tuple(
+        cls_obj.info_dic[x] for x in ("LATEST_VERSION", "DOWNLOAD_LINK", "FILE_MD5", "FILE_SHA1", "FILE_SHA256")
+    )
+
+def _verify_download(cls_obj, start_time):
+    """
+    下载并校验cls_obj的文件
+    哈希值不一致时不保存也不推送这次更新, 并记住这个文件(版本 下载链接和发布的哈希值),
+    之后的检查遇到同一个文件时直接跳过, 不再重复下载; 上游重新发布(哈希值或链接变化)后才会再次校验
+    :return: 是否应该保存并推送这次更新, 校验过程中发生其他异常时也返回True
+    """
+    download_key = _get_download_key(cls_obj)
+    if _REJECTED_DOWNLOADS.get(cls_obj.name) == download_key:
+        METRICS.inc("file_verify_total", checker=cls_obj.name, result="skipped")
+        _print(" rejected before, skipped")
+        write_log_info(
+            "%s: %s was rejected before, skipped" % (cls_obj.fullname, cls_obj.info_dic["LATEST_VERSION"]),
+            **_log_fields(cls_obj, start_time, "rejected")
+        )
+        return False
+    try:
+        with METRICS.timer("check_phase_seconds", checker=cls_obj.name, phase="verify"):
+            verified = cls_obj.verify_download()
+    except HashMismatch as error:
+        _REJECTED_DOWNLOADS[cls_obj.name] = download_key
+        METRICS.inc("file_verify_total", checker=cls_obj.name, result="mismatch")
+        _print("\n! File verification failed! %s" % error)
+        write_log_warning(
+            "%s: File verification failed! %s" % (cls_obj.fullname, error),
+            **_log_fields(cls_obj, start_time, "rejected")
+        )
+        return False
+    except:
+        METRICS.inc("file_verify_total", checker=cls_obj.name, result="error")
+        _print("\n%s\n! Something wrong when verifying the file!" % traceback.format_exc())
+        write_log_exception(
+            "%s: Something wrong when verifying the file!" % cls_obj.fullname, checker=cls_obj.name
+        )
+        return True
+    if verified:
+        METRICS.inc("file_verify_total", checker=cls_obj.name, result="ok")
+    return True
+
 def check_one(cls):
     if isinstance(cls, str):
         for item in CHECK_LIST:
@@ -63,84 +160,312 @@ def check_one(cls):
         else:
             raise Exception("Can not found '%s' from CHECK_LIST!" % cls)
     cls_obj = cls()
-    print("- Checking", cls_obj.fullname, "...", end="")
+    start_time = time.time()
+    _print("- Checking", cls_obj.fullname, "...", end="")
     try:
-        cls_obj.do_check()
+        with METRICS.timer("check_phase_seconds", checker=cls_obj.name, phase="fetch_parse"):
+            cls_obj.run_do_check(conditional=not FORCE_UPDATE)
+    except NotModified as error:
+        reason = "unchanged" if isinstance(error, ContentUnchanged) else "not modified"
+        _print(" no update (%s)" % reason)
+        write_log_info(
+            "%s no update (%s)" % (cls_obj.fullname, reason),
+            **_log_fields(cls_obj, start_time, reason.replace(" ", "_"))
+        )
+        return True
     except Exception as error:
+        METRICS.inc("check_errors_total", checker=cls_obj.name, error=type(error).__name__)
         if isinstance(error, exceptions.ReadTimeout):
-            print("\n! Check failed! Timeout.")
-            write_log_warning("%s check failed! Timeout." % cls_obj.fullname)
+            _print("\n! Check failed! Timeout.")
+            write_log_warning(
+                "%s check failed! Timeout." % cls_obj.fullname,
+                **_log_fields(cls_obj, start_time, "timeout")
+            )
         elif isinstance(error, (exceptions.SSLError, exceptions.ProxyError)):
-            print("\n! Check failed! Proxy error.")
-            write_log_warning("%s check failed! Proxy error." % cls_obj.fullname)
+            _print("\n! Check failed! Proxy error.")
+            write_log_warning(
+                "%s check failed! Proxy error." % cls_obj.fullname,
+                **_log_fields(cls_obj, start_time, "proxy_error")
+            )
+        elif isinstance(error, CircuitOpen):
+            _print("\n! Check failed! Host is unavailable (circuit open).")
+            write_log_warning(
+                "%s check failed! %s." % (cls_obj.fullname, error),
+                **_log_fields(cls_obj, start_time, "circuit_open")
+            )
         elif isinstance(error, ErrorCode):
-            print("\n! Check failed! Error code: %s." % error)
-            write_log_warning("%s check failed! Error code: %s." % (cls_obj.fullname, error))
+            _print("\n! Check failed! Error code: %s." % error)
+            write_log_warning(
+                "%s check failed! Error code: %s." % (cls_obj.fullname, error),
+                **_log_fields(cls_obj, start_time, "error_code")
+            )
         else:
-            traceback_string = traceback.format_exc()
-            print("\n%s\n! Check failed!" % traceback_string)
-            write_log_warning(*traceback_string.splitlines())
-            write_log_warning("%s check failed!" % cls_obj.fullname)
+            _print("\n%s\n! Check failed!" % traceback.format_exc())
+            write_log_exception(
+                "%s check failed!" % cls_obj.fullname,
+                **_log_fields(cls_obj, start_time, "error")
+            )
         if DEBUG_ENABLE:
             if input("* Continue?(Y/N) ").upper() != "Y":
                 _abort_by_user()
         return False
-    if cls_obj.is_updated() or FORCE_UPDATE:
-        print("\n> New build:", cls_obj.info_dic["LATEST_VERSION"])
-        write_log_info("%s has updates: %s" % (cls_obj.fullname, cls_obj.info_dic["LATEST_VERSION"]))
+    with METRICS.timer("check_phase_seconds", checker=cls_obj.name, phase="db"):
+        is_updated = cls_obj.is_updated()
+    if is_updated or FORCE_UPDATE:
+        _print("\n> New build:", cls_obj.info_dic["LATEST_VERSION"])
         try:
-            cls_obj.after_check()
+            with METRICS.timer("check_phase_seconds", checker=cls_obj.name, phase="after_check"):
+                cls_obj.after_check()
         except:
-            traceback_string = traceback.format_exc()
-            print("\n%s\n! Something wrong when running after_check!" % traceback_string)
-            write_log_warning(*traceback_string.splitlines())
-            write_log_warning("%s: Something wrong when running after_check!" % cls_obj.fullname)
-        cls_obj.write_to_database()
-        if (ENABLE_SENDMESSAGE and not DONT_POST) or FORCE_UPDATE:
-            send_message(cls_obj.get_print_text())
+            _print("\n%s\n! Something wrong when running after_check!" % traceback.format_exc())
+            write_log_exception(
+                "%s: Something wrong when running after_check!" % cls_obj.fullname,
+                checker=cls_obj.name
+            )
+        # 回放时不访问网络, 因此不下载文件
+        # 校验失败不算检查失败(不会立即重试), 也不保存ETag等检查状态, 下次检查时重新解析
+        if ENABLE_FILE_VERIFY and cls_obj.enable_file_verify and not CASSETTE.replaying \
+                and not _verify_download(cls_obj, start_time):
+            return True
+        write_log_info(
+            "%s has updates: %s" % (cls_obj.fullname, cls_obj.info_dic["LATEST_VERSION"]),
+            **_log_fields(cls_obj, start_time, "updated")
+        )
+        if is_updated:
+            SAVED_SNAPSHOT.add(
+                UpdateHistory, ID=cls_obj.name, UPDATE_TIME=time.time(),
+                LATEST_VERSION=cls_obj.info_dic["LATEST_VERSION"]
+            )
+        with METRICS.timer("check_phase_seconds", checker=cls_obj.name, phase="db"):
+            cls_obj.write_to_database()
+        if ((ENABLE_SENDMESSAGE and not DONT_POST) or FORCE_UPDATE) and not CASSETTE.replaying:
+            with METRICS.timer("check_phase_seconds", checker=cls_obj.name, phase="notify"):
+                post_message(cls_obj.get_print_text())
     else:
-        print(" no update")
-        write_log_info("%s no update" % cls_obj.fullname)
+        _print(" no update")
+        write_log_info(
+            "%s no update" % cls_obj.fullname,
+            **_log_fields(cls_obj, start_time, "no_update")
+        )
+    with METRICS.timer("check_phase_seconds", checker=cls_obj.name, phase="db"):
+        cls_obj.save_check_state()
     return True
 
-def loop_check():
-    write_log_info("Run database cleanup before start")
-    drop_ids = database_cleanup()
-    write_log_info("Abandoned items: {%s}" % ", ".join(drop_ids))
-    req_failed_flag = 0
-    while True:
-        check_failed_list = []
+def _check_one_buffered(cls):
+    """ 在工作线程中执行check_one, 并将该项目的全部输出一次性打印 """
+    _THREAD_LOCAL.buffer = []
+    try:
+        return check_one(cls)
+    finally:
+        with _PRINT_LOCK:
+            print("".join(_THREAD_LOCAL.buffer), end="")
+        _THREAD_LOCAL.buffer = None
+
+class _FailureCounter:
+
+    """ 记录连续检查失败的次数, 多线程下按检查完成的顺序计数 """
+
+    def __init__(self, limit=5):
+        self.limit = limit
+        self.count = 0
+        self.__lock = threading.Lock()
+
+    def record(self, result):
+        """
+        记录一次检查结果, 连续失败次数达到上限时检查代理服务器是否可以连接
+        只有代理服务器无法连接时才返回True, 否则清零计数, 继续检查
+        :param result: check_one的返回值
+        :return: 是否应该终止程序
+        """
+        with self.__lock:
+            self.count = 0 if result else self.count + 1
+            if self.count < self.limit:
+                return False
+            self.count = 0
+        if is_proxy_reachable():
+            write_log_warning("%d consecutive checks failed, but the proxy is reachable" % self.limit)
+            return False
+        return True
+
+def _check_sequential(cls_list, failure_counter=None):
+    check_failed_list = []
+    for cls in cls_list:
+        result = check_one(cls)
+        if not result:
+            check_failed_list.append(cls)
+        if failure_counter is not None and failure_counter.record(result):
+            _abort("Proxy is unreachable! Abort...")
+    return check_failed_list
+
+def _check_concurrent(cls_list, failure_counter=None):
+    check_failed_list = []
+    executor = ThreadPoolExecutor(max_workers=MAX_THREADS_NUM)
+    try:
+        futures = {executor.submit(_check_one_buffered, cls): cls for cls in cls_list}
+        for future in as_completed(futures):
+            result = future.result()
+            if not result:
+                check_failed_list.append(futures[future])
+            if failure_counter is not None and failure_counter.record(result):
+                executor.shutdown(wait=False, cancel_futures=True)
+                _abort("Proxy is unreachable! Abort...")
+    except KeyboardInterrupt:
+        executor.shutdown(wait=False, cancel_futures=True)
+        _abort_by_user()
+    finally:
+        executor.shutdown(wait=True)
+    # 保持与CHECK_LIST相同的顺序, 便于重试时的输出与日志阅读
+    return [cls for cls in cls_list if cls in check_failed_list]
+
+def check_items(cls_list, failure_counter=None):
+    """
+    检查cls_list中的所有项目
+    启用多线程时(调试模式除外)使用线程池并发检查, 否则逐个检查
+    :param cls_list: CheckUpdate子类的列表
+    :param failure_counter: _FailureCounter对象, 为None时不检查连续失败次数
+    :return: 检查失败的项目列表
+    """
+    if ENABLE_MULTI_THREAD and not DEBUG_ENABLE:
+        return _check_concurrent(cls_list, failure_counter)
+    return _check_sequential(cls_list, failure_counter)
+
+def _wait(scheduler):
+    try:
+        scheduler.wait()
+    except KeyboardInterrupt:
+        _abort_by_user()
+
+def _claim_due_items(work_leases, scheduler, due_list):
+    """
+    取得due_list中各个项目的租约, 没有取得的项目按共享的下次检查时间重新加入队列:
+    已由其他进程检查过的项目使用新的下次检查时间, 正在被其他进程检查的项目在其租约到期时再尝试,
+    超出LEASE_CLAIM_LIMIT的项目仍然是到期的, 下一轮会再次尝试
+    :return: 取得了租约的项目列表
+    """
+    claimed = work_leases.claim(
+        [cls.__name__ for cls in due_list], {cls.__name__ for cls in scheduler.last_requested}
+    )
+    skipped = [cls for cls in due_list if cls.__name__ not in claimed]
+    if skipped:
+        next_due_times = Lease.get_next_due_times([cls.__name__ for cls in skipped])
+        scheduler.schedule_at({
+            cls: next_due_times.get(cls.__name__, time.time() + work_leases.ttl) for cls in skipped
+        })
+    return [cls for cls in due_list if cls.__name__ in claimed]
+
+def _drain_outbox_once():
+    """
+    单次检查结束时发送发件箱中的消息
+    发送之前需要取得"@outbox"租约, 同时运行着 --auto/--daemon 进程时由该进程发送, 以免同一条消息被发送两次
+    """
+    work_leases = WorkLeases()
+    if not work_leases.acquire_role("outbox"):
+        print(" - Messages will be posted by the running process that holds the outbox lease")
+        return
+    work_leases.start()
+    try:
+        OUTBOX.drain()
+    finally:
+        work_leases.release_role("outbox")
+
+def loop_check(daemon=False, max_rounds=0):
+    """
+    循环检查CHECK_LIST中的项目
+    启用ENABLE_WORK_LEASES时, 多个共享同一个数据库的进程通过租约分配检查项目(见leases.WorkLeases),
+    清理数据库和发送消息只由一个进程执行
+    :param daemon: 是否同时启动本地控制接口(见control_api.ControlAPI), 用于立即检查 查询状态和暂停/恢复调度
+    :param max_rounds: 检查多少轮之后返回, 为0时一直循环
+    """
+    work_leases = None
+    if ENABLE_WORK_LEASES:
+        work_leases = WorkLeases()
+        work_leases.start()
+        write_log_info("Work leases enabled, owner: %s" % work_leases.owner)
+    if work_leases is None or work_leases.acquire_role("cleanup"):
+        write_log_info("Run database cleanup before start")
+        drop_ids = database_cleanup()
+        write_log_info("Abandoned items: {%s}" % ", ".join(drop_ids))
+        if work_leases is not None:
+            work_leases.release_role("cleanup")
+    failure_counter = _FailureCounter(limit=5)
+    scheduler = Scheduler(CHECK_LIST)
+    # --dontpost时发件箱中已有的消息也不发送, 回放时不访问网络
+    if not DONT_POST and not CASSETTE.replaying:
+        # 没有启用ENABLE_WORK_LEASES时也只在持有"@outbox"租约时发送, 以免与同时运行的 -c 重复发送同一条消息
+        outbox_leases = work_leases
+        if outbox_leases is None:
+            outbox_leases = WorkLeases()
+            outbox_leases.start()
+        OUTBOX.start(should_drain=lambda: outbox_leases.acquire_role("outbox"))
+    if METRICS_PORT and not CASSETTE.replaying:
+        try:
+            start_metrics_server(METRICS_HOST, METRICS_PORT)
+            write_log_info("Metrics server started at http://%s:%d/metrics" % (METRICS_HOST, METRICS_PORT))
+        except OSError as error:
+            # 同一台主机上运行多个进程时端口可能已被占用, 指标服务不影响检查, 因此只记录警告
+            print(" - Failed to start metrics server: %s" % error)
+            write_log_warning("Failed to start metrics server: %s" % error)
+    if daemon:
+        control_api = ControlAPI(
+            scheduler, CHECK_LIST, lambda: [get_pool_stats_text(), CYCLE_CACHE.get_stats_text()]
+        )
+        start_control_server(CONTROL_HOST, CONTROL_PORT, control_api)
+        print(" - Control API listening at http://%s:%d" % (CONTROL_HOST, CONTROL_PORT))
+        write_log_info("Control API started at http://%s:%d" % (CONTROL_HOST, CONTROL_PORT))
+    rounds = 0
+    while not max_rounds or rounds < max_rounds:
+        due_list = scheduler.pop_due()
+        if due_list and work_leases is not None:
+            due_list = _claim_due_items(work_leases, scheduler, due_list)
+        if not due_list:
+            _wait(scheduler)
+            continue
+        CHECK_RESULTS.start_round()
         start_time = _get_time_str()
         print(" - " + start_time)
-        print(" - Start...")
+        print(" - Start... (%d/%d items due)" % (len(due_list), len(CHECK_LIST)))
         write_log_info("=" * 64)
-        write_log_info("Start checking at %s" % start_time)
-        for cls in CHECK_LIST:
-            result = check_one(cls)
-            if not result:
-                req_failed_flag += 1
-                check_failed_list.append(cls)
-            else:
-                req_failed_flag = 0
-            if req_failed_flag == 5:
-                _abort("Network or proxy error! Abort...")
-            _sleep(2)
+        write_log_info("Start checking at %s, %d items due" % (start_time, len(due_list)))
+        SAVED_SNAPSHOT.reload()
+        check_failed_list = check_items(due_list, failure_counter)
         print(" - Check again for failed items...")
         write_log_info("Check again for failed items")
-        for cls in check_failed_list:
-            check_one(cls)
-            _sleep(2)
-        PE_PAGE_BS_CACHE.clear()
-        print(" - The next check will start at %s\n" % _get_time_str(offset=LOOP_CHECK_INTERVAL))
+        check_items(check_failed_list)
+        with METRICS.timer("db_write_seconds"):
+            SAVED_SNAPSHOT.flush()
+        OUTBOX.flush()
+        due_times = scheduler.reschedule(due_list)
+        if work_leases is not None:
+            work_leases.release({cls.__name__: due_time for cls, due_time in due_times.items()})
+        CHECK_RESULTS.end_round()
+        for stats_text in (get_pool_stats_text(), CYCLE_CACHE.get_stats_text()):
+            print(" - %s" % stats_text)
+            write_log_info(stats_text)
+        # 轮与轮之间不保留缓存的页面和解析结果, 否则它们会一直占用内存直到下一轮开始
+        CYCLE_CACHE.new_cycle()
+        if scheduler.paused:
+            print(" - Scheduling is paused\n")
+        else:
+            print(" - The next check will start at %s\n" % _get_time_str(scheduler.next_due_time()))
         write_log_info("End of check")
-        _sleep(LOOP_CHECK_INTERVAL)
+        rounds += 1
 
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("--force", help="Force save to database & send message to Telegram", action="store_true")
     parser.add_argument("--dontpost", help="Do not send message to Telegram", action="store_true")
     parser.add_argument("-a", "--auto", help="Automatically loop check all items", action="store_true")
+    parser.add_argument(
+        "-d", "--daemon", help="Loop check all items and serve a local control API", action="store_true"
+    )
     parser.add_argument("-c", "--check", help="Check one item")
+    parser.add_argument("--no-cache", help="Bypass the on-disk HTTP response cache", action="store_true")
+    parser.add_argument("--record", help="Record all responses to a cassette file", metavar="FILE")
+    parser.add_argument(
+        "--replay", metavar="FILE",
+        help="Replay responses from a cassette file on a copy of the database, without network or messages"
+    )
+    parser.add_argument("--rounds", help="Stop after this many check rounds (0 = forever)", type=int, default=0)
 
     args = parser.parse_args()
 
@@ -148,9 +473,26 @@ if __name__ == "__main__":
         FORCE_UPDATE = True
     elif args.dontpost:
         DONT_POST = True
-    if args.auto:
-        loop_check()
+    if args.no_cache:
+        DISK_CACHE.enabled = False
+    if args.record and args.replay:
+        parser.error("--record and --replay can not be used together")
+    if args.record:
+        CASSETTE.start_recording(args.record)
+    elif args.replay:
+        print(" - Replaying %d responses from %s" % (CASSETTE.start_replay(args.replay), args.replay))
+        # 回放的结果写入数据库的临时副本, 否则正式数据库中的项目会被标记为已检查到更新, 却没有发送过消息
+        replay_db = os.path.join(tempfile.mkdtemp(prefix="replay-"), os.path.basename(SQLITE_FILE))
+        use_database_copy(replay_db)
+        print(" - Using a copy of the database: %s" % replay_db)
+    if args.daemon:
+        loop_check(daemon=True, max_rounds=args.rounds)
+    elif args.auto:
+        loop_check(max_rounds=args.rounds)
     elif args.check:
         check_one(args.check)
+        SAVED_SNAPSHOT.flush()
+        if not DONT_POST and not CASSETTE.replaying:
+            _drain_outbox_once()
     else:
         parser.print_usage()
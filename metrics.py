@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+_HELP = {
+    "check_total": "Number of finished checks by outcome",
+    "check_phase_seconds": "Time spent in each phase of check_one",
+    "http_request_seconds": "Time spent on network requests made by request_url",
+    "http_response_bytes_total": "Response body bytes received by request_url",
+    "http_cache_total": "request_url lookups by source (hit: cycle cache, disk_hit: disk cache, replay: cassette)",
+    "parse_seconds": "Time spent building BeautifulSoup trees in get_bs",
+    "db_write_seconds": "Time spent flushing queued check results to the database",
+    "check_errors_total": "Failed checks by error class",
+    "file_verify_total": "Download hash verifications by result",
+    "telegram_send_total": "Messages sent from the outbox to Telegram by result",
+    "telegram_send_seconds": "Time spent sending messages to Telegram",
+}
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+
+class Metrics:
+
+    """
+    进程内的指标registry, 只支持两种指标:
+    counter: 只增不减的计数, 对应inc方法
+    summary: 记录观测值的次数 总和与最大值, 对应observe方法和timer上下文管理器
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters = {}
+        self.__summaries = {}
+        self.start_time = time.time()
+
+    def inc(self, name, value=1, **labels):
+        """ 计数器name(带标签labels)增加value """
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """ 记录一次name(带标签labels)的观测值 """
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.__lock:
+            count, sum_, max_ = self.__summaries.get(key, (0, 0, 0))
+            self.__summaries[key] = (count + 1, sum_ + value, max(max_, value))
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """ 记录with块执行的时间(秒), 即使发生异常也会记录 """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def to_dict(self):
+        """ 返回所有指标的字典, 用于JSON输出 """
+        with self.__lock:
+            counters = dict(self.__counters)
+            summaries = dict(self.__summaries)
+        result = {"uptime_seconds": round(time.time() - self.start_time, 3), "metrics": {}}
+        for (name, labels), value in counters.items():
+            result["metrics"].setdefault(name, []).append({"labels": dict(labels), "value": value})
+        for (name, labels), (count, sum_, max_) in summaries.items():
+            result["metrics"].setdefault(name, []).append({
+                "labels": dict(labels), "count": count, "sum": round(sum_, 6), "max": round(max_, 6)
+            })
+        return result
+
+    def to_prometheus(self):
+        """ 返回Prometheus文本格式(text/plain; version=0.0.4)的指标 """
+        with self.__lock:
+            counters = sorted(self.__counters.items())
+            summaries = sorted(self.__summaries.items())
+        lines = []
+        last_name = None
+        for (name, labels), value in counters:
+            if name != last_name:
+                lines.append("# HELP %s %s" % (name, _HELP.get(name, name)))
+                lines.append("# TYPE %s counter" % name)
+                last_name = name
+            lines.append("%s%s %s" % (name, _format_labels(labels), value))
+        for (name, labels), (count, sum_, _) in summaries:
+            if name != last_name:
+                lines.append("# HELP %s %s" % (name, _HELP.get(name, name)))
+                lines.append("# TYPE %s summary" % name)
+                last_name = name
+            lines.append("%s_count%s %d" % (name, _format_labels(labels), count))
+            lines.append("%s_sum%s %.6f" % (name, _format_labels(labels), sum_))
+        # 最大值不属于Prometheus summary的标准样本, 作为单独的gauge输出
+        for (name, labels), (_, _, max_) in summaries:
+            if name + "_max" != last_name:
+                last_name = name + "_max"
+                lines.append("# HELP %s Maximum of %s" % (last_name, name))
+                lines.append("# TYPE %s gauge" % last_name)
+            lines.append("%s%s %.6f" % (last_name, _format_labels(labels), max_))
+        lines.append("# TYPE process_uptime_seconds gauge")
+        lines.append("process_uptime_seconds %.3f" % (time.time() - self.start_time))
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+
+def _get_response(path):
+    """
+    返回指标HTTP服务对path的响应
+    :return: (正文, Content-Type), path不存在时返回None
+    """
+    if path == "/metrics":
+        return METRICS.to_prometheus().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+    if path == "/metrics.json":
+        body = json.dumps(METRICS.to_dict(), ensure_ascii=False, indent=2).encode("utf-8")
+        return body, "application/json; charset=utf-8"
+    return None
+
+def start_metrics_server(host, port):
+    """
+    在后台线程中启动指标HTTP服务
+    GET /metrics 返回Prometheus文本格式, GET /metrics.json 返回JSON
+    :return: ThreadingHTTPServer对象
+    """
+    # 只有循环检查模式才会启动指标服务, 因此在这里才导入http.server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            response = _get_response(self.path)
+            if response is None:
+                self.send_error(404)
+                return
+            body, content_type = response
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="MetricsServer", daemon=True).start()
+    return server
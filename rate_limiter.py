@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import threading
+import time
+from urllib.parse import urlsplit
+
+from config import RATE_LIMIT_DEFAULT, RATE_LIMIT_HOSTS
+
+class TokenBucket:
+
+    """
+    令牌桶: 以rate个/秒的速度补充令牌, 最多积攒burst个
+    令牌不足时调用者会预支令牌并等待, 因此并发的调用者按到达顺序依次放行
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.__tokens = burst
+        self.__last_time = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        """
+        取出一个令牌, 必要时阻塞等待
+        :return: 等待的时间(秒)
+        """
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.burst, self.__tokens + (now - self.__last_time) * self.rate)
+            self.__last_time = now
+            self.__tokens -= 1
+            wait_time = max(-self.__tokens / self.rate, 0)
+        if wait_time:
+            time.sleep(wait_time)
+        return wait_time
+
+class HostRateLimiter:
+
+    """ 为每个主机分别维护一个令牌桶, 参数见RATE_LIMIT_DEFAULT和RATE_LIMIT_HOSTS """
+
+    def __init__(self, default=RATE_LIMIT_DEFAULT, hosts=None):
+        self.__default = default
+        self.__hosts = RATE_LIMIT_HOSTS if hosts is None else hosts
+        self.__buckets = {}
+        self.__lock = threading.Lock()
+
+    def get_bucket(self, host):
+        """ 返回host对应的令牌桶, 首次调用时创建 """
+        with self.__lock:
+            bucket = self.__buckets.get(host)
+            if bucket is None:
+                bucket = self.__buckets[host] = TokenBucket(*self.__hosts.get(host, self.__default))
+            return bucket
+
+    def wait(self, url):
+        """
+        在向url发出请求之前调用, 如果url所在主机的请求速率超出限制则阻塞等待
+        :param url: 要请求的url
+        :return: 等待的时间(秒)
+        """
+        return self.get_bucket(urlsplit(url).hostname).acquire()
+
+RATE_LIMITER = HostRateLimiter()
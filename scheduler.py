@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from config import LOOP_CHECK_INTERVAL, ENABLE_ADAPTIVE_SCHEDULE, SCHEDULE_MIN_INTERVAL, \
+                   SCHEDULE_MAX_INTERVAL, SCHEDULE_JITTER, SCHEDULE_CHECKS_PER_UPDATE, \
+                   SCHEDULE_BATCH_WINDOW
+from database import UpdateHistory
+
+def get_check_interval(update_times, now=None):
+    """
+    根据项目的更新历史计算检查间隔
+    以最近几次更新的平均间隔与距离上次更新的时间中较大的值作为预计的更新间隔,
+    在预计的更新间隔内检查SCHEDULE_CHECKS_PER_UPDATE次, 长期没有更新的项目会逐渐降低检查频率
+    更新记录少于两次时使用LOOP_CHECK_INTERVAL
+    :param update_times: 检测到更新的时间戳列表(升序)
+    :param now: 当前时间戳, 默认为time.time()
+    :return: 检查间隔(秒), 已限制在SCHEDULE_MIN_INTERVAL与SCHEDULE_MAX_INTERVAL之间, 不含随机抖动
+    """
+    if not ENABLE_ADAPTIVE_SCHEDULE:
+        return LOOP_CHECK_INTERVAL
+    if len(update_times) < 2:
+        interval = LOOP_CHECK_INTERVAL
+    else:
+        if now is None:
+            now = time.time()
+        mean_gap = (update_times[-1] - update_times[0]) / (len(update_times) - 1)
+        interval = max(mean_gap, now - update_times[-1]) / SCHEDULE_CHECKS_PER_UPDATE
+    return min(max(interval, SCHEDULE_MIN_INTERVAL), SCHEDULE_MAX_INTERVAL)
+
+class Scheduler:
+
+    """
+    按每个项目各自的下次检查时间调度检查(优先队列)
+    下次检查时间 = 本次检查时间 + get_check_interval计算的间隔 ± SCHEDULE_JITTER的随机抖动
+    get_schedule_group相同的项目(如同一个GroupCheck数据源的成员)作为一个整体调度: 使用组内最短的间隔和同一个抖动,
+    其中任一项目到期时其余项目也一起取出, 以便共享同一次请求和解析
+    其他线程可以通过check_now要求立即检查某些项目, 也可以暂停/恢复调度, 这些操作会唤醒正在wait的检查循环
+    """
+
+    def __init__(self, cls_list, start_time=None):
+        if start_time is None:
+            start_time = time.time()
+        self.__lock = threading.Lock()
+        self.__counter = itertools.count()
+        self.__heap = []
+        self.__due_times = {}
+        self.__requested = set()
+        self.__wakeup = threading.Event()
+        self.paused = False
+        # 最近一次pop_due取出的项目中, 通过check_now要求立即检查的项目
+        self.last_requested = set()
+        self.__groups = {}
+        for cls in cls_list:
+            self.__groups.setdefault(cls.get_schedule_group(), []).append(cls)
+            self.__push(cls, start_time)
+
+    def __push(self, cls, due_time):
+        self.__due_times[cls] = due_time
+        heapq.heappush(self.__heap, (due_time, next(self.__counter), cls))
+
+    def __len__(self):
+        return len(self.__due_times)
+
+    def next_due_time(self):
+        """ 返回最早的下次检查时间, 队列为空时返回None """
+        with self.__lock:
+            while self.__heap:
+                due_time, _, cls = self.__heap[0]
+                if self.__due_times.get(cls) == due_time:
+                    return due_time
+                heapq.heappop(self.__heap)
+            return None
+
+    def get_due_times(self):
+        """ 返回{项目: 下次检查时间}, 正在检查的项目不在其中 """
+        with self.__lock:
+            return dict(self.__due_times)
+
+    def pop_due(self, now=None):
+        """
+        取出所有已到期的项目, 在SCHEDULE_BATCH_WINDOW秒内即将到期的项目也会一起取出,
+        以便同一来源的项目尽量在同一轮检查中共享请求缓存
+        暂停调度时只取出通过check_now要求立即检查的项目
+        取出的项目需要在检查结束后调用reschedule重新加入队列
+        :param now: 当前时间戳, 默认为time.time()
+        :return: CheckUpdate子类的列表, 按到期时间排序
+        """
+        if now is None:
+            now = time.time()
+        due_list = []
+        with self.__lock:
+            if self.paused:
+                due_list = [cls for cls in self.__requested if cls in self.__due_times]
+                for cls in due_list:
+                    del self.__due_times[cls]
+            else:
+                while self.__heap and self.__heap[0][0] <= now + SCHEDULE_BATCH_WINDOW:
+                    due_time, _, cls = heapq.heappop(self.__heap)
+                    if self.__due_times.get(cls) == due_time:
+                        del self.__due_times[cls]
+                        due_list.append(cls)
+                # 同组的其他项目(没有正在检查的)提前一起检查, 队列中剩下的旧记录会在出队时被忽略
+                for cls in list(due_list):
+                    for member in self.__groups.get(cls.get_schedule_group(), ()):
+                        if member in self.__due_times:
+                            del self.__due_times[member]
+                            due_list.append(member)
+            self.last_requested = self.__requested.intersection(due_list)
+            self.__requested.difference_update(due_list)
+        return due_list
+
+    def schedule_at(self, due_times):
+        """
+        将项目按指定的时间重新加入队列, 用于没有取得租约(由其他进程检查)的项目
+        :param due_times: {CheckUpdate子类: 下次检查时间}
+        """
+        with self.__lock:
+            for cls, due_time in due_times.items():
+                self.__push(cls, due_time)
+
+    def check_now(self, cls_list, now=None):
+        """
+        要求立即检查cls_list中的项目(即使调度已暂停), 正在检查的项目会在本轮结束后再检查一次
+        :param cls_list: CheckUpdate子类的列表
+        :param now: 当前时间戳, 默认为time.time()
+        """
+        if now is None:
+            now = time.time()
+        with self.__lock:
+            for cls in cls_list:
+                self.__requested.add(cls)
+                if cls in self.__due_times:
+                    self.__push(cls, now)
+        self.__wakeup.set()
+
+    def pause(self):
+        """ 暂停调度, 之后只检查通过check_now要求立即检查的项目 """
+        with self.__lock:
+            self.paused = True
+        self.__wakeup.set()
+
+    def resume(self):
+        """ 恢复调度, 暂停期间到期的项目会立即检查 """
+        with self.__lock:
+            self.paused = False
+        self.__wakeup.set()
+
+    def wait(self):
+        """
+        等待到下一个项目到期, 或者被check_now/pause/resume唤醒
+        暂停调度且没有要求立即检查的项目时一直等待
+        """
+        with self.__lock:
+            timeout = None
+            if self.__requested:
+                timeout = 0
+            elif not self.paused and self.__heap:
+                timeout = max(self.__heap[0][0] - time.time(), 0)
+        self.__wakeup.wait(timeout)
+        self.__wakeup.clear()
+
+    def reschedule(self, cls_list, now=None):
+        """
+        根据数据库中的更新历史, 计算cls_list中每个项目的下次检查时间并重新加入队列
+        同组的项目使用组内最短的检查间隔和同一个随机抖动, 因此下次检查时间相同
+        :param cls_list: CheckUpdate子类的列表
+        :param now: 当前时间戳, 默认为time.time()
+        :return: {CheckUpdate子类: 下次检查时间}
+        """
+        if now is None:
+            now = time.time()
+        update_times = UpdateHistory.get_update_times([cls.__name__ for cls in cls_list])
+        due_times = {}
+        groups = {}
+        with self.__lock:
+            for cls in cls_list:
+                if cls in self.__requested:
+                    due_times[cls] = now
+                    self.__push(cls, now)
+                    continue
+                groups.setdefault(cls.get_schedule_group(), []).append(cls)
+            for members in groups.values():
+                interval = min(get_check_interval(update_times.get(x.__name__, []), now) for x in members)
+                if ENABLE_ADAPTIVE_SCHEDULE and SCHEDULE_JITTER:
+                    interval *= 1 + random.uniform(-SCHEDULE_JITTER, SCHEDULE_JITTER)
+                for cls in members:
+                    due_times[cls] = now + interval
+                    self.__push(cls, now + interval)
+        return due_times
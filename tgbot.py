@@ -1,26 +1,196 @@
 #!/usr/bin/env python3
 # encoding: utf-8
 
-import traceback
+import threading
+import time
 
-import telebot
+from config import TG_TOKEN, TG_SENDTO, _PROXIES_DIC, TG_RATE_LIMIT, OUTBOX_POLL_INTERVAL, \
+                   OUTBOX_MAX_ATTEMPTS
+from database import DB_WRITER, SAVED_SNAPSHOT, OutboxMessage
+from logger import write_log_info, write_log_warning, write_log_exception
+from metrics import METRICS
+from rate_limiter import TokenBucket
 
-from config import TG_TOKEN, TG_SENDTO, _PROXIES_DIC
-from logger import write_log_warning
+_BOT = None
+_BOT_LOCK = threading.Lock()
 
-BOT = telebot.TeleBot(TG_TOKEN)
-telebot.apihelper.proxy = _PROXIES_DIC
+# Telegram单条消息的最大长度
+MESSAGE_MAX_LENGTH = 4096
+
+# 合并多条消息时使用的分隔符
+_MESSAGE_SEPARATOR = "\n\n" + "-" * 16 + "\n\n"
+
+def get_bot():
+    """
+    返回telebot.TeleBot对象, 首次调用时才导入telebot并创建
+    不发送消息的运行方式(如--dontpost且发件箱为空)不需要承担导入telebot的开销
+    """
+    global _BOT
+    if _BOT is None:
+        with _BOT_LOCK:
+            if _BOT is None:
+                import telebot
+                telebot.apihelper.proxy = _PROXIES_DIC
+                _BOT = telebot.TeleBot(TG_TOKEN)
+    return _BOT
 
 def send_message(text, user=TG_SENDTO):
-    try:
-        BOT.send_message(user, text, parse_mode="Markdown")
-    except:
-        # try again
+    """
+    立即发送消息, 失败时抛出异常
+    一般不应直接调用此方法, 而是使用post_message放入发件箱, 由后台线程发送
+    """
+    get_bot().send_message(user, text, parse_mode="Markdown")
+
+def _get_retry_after(error):
+    result_json = getattr(error, "result_json", None) or {}
+    return result_json.get("parameters", {}).get("retry_after")
+
+def _merge_messages(rows):
+    """
+    将同一个聊天的多条消息合并, 每条合并后的消息不超过MESSAGE_MAX_LENGTH
+    :param rows: [(ID, CHAT_ID, TEXT, ATTEMPTS)]
+    :return: [(合并后的消息文本, [被合并的行])]
+    """
+    batches = []
+    for row in rows:
+        if batches:
+            text, batch_rows = batches[-1]
+            merged_text = text + _MESSAGE_SEPARATOR + row.TEXT
+            if len(merged_text) <= MESSAGE_MAX_LENGTH:
+                batches[-1] = (merged_text, batch_rows + [row])
+                continue
+        batches.append((row.TEXT[:MESSAGE_MAX_LENGTH], [row]))
+    return batches
+
+class Outbox:
+
+    """
+    持久化的发件箱, 消息先写入数据库的outbox表, 由后台线程发送, 检查过程不需要等待发送完成
+    同一个聊天中待发送的多条消息会被合并成尽量少的消息, 发送速率受TG_RATE_LIMIT限制
+    发送失败的消息按指数退避重试, 程序重启后未发送的消息仍会继续发送
+    """
+
+    def __init__(self):
+        self.__event = threading.Event()
+        self.__lock = threading.Lock()
+        self.__drain_lock = threading.Lock()
+        self.__thread = None
+        self.__buckets = {}
+        self.__should_drain = None
+
+    def put(self, text, user=TG_SENDTO):
+        """
+        将消息放入发件箱
+        消息与检查结果一起暂存在SAVED_SNAPSHOT中, 在同一个事务中写入数据库,
+        因此不会出现消息已经发送 但检查结果没有保存(重启后重复发送)的情况
+        """
+        SAVED_SNAPSHOT.add_new(
+            OutboxMessage, CHAT_ID=str(user), TEXT=text, CREATE_TIME=time.time(), ATTEMPTS=0, NEXT_TRY_TIME=0
+        )
+
+    def start(self, should_drain=None):
+        """
+        启动后台发送线程
+        :param should_drain: 无参数的函数, 返回False时本次不发送(如多个进程共享数据库时, 只由持有租约的进程发送)
+        """
+        self.__should_drain = should_drain
+        with self.__lock:
+            if self.__thread is None or not self.__thread.is_alive():
+                self.__thread = threading.Thread(target=self.__run, name="Outbox", daemon=True)
+                self.__thread.start()
+
+    def flush(self):
+        """ 唤醒后台线程立即发送, 应在每轮检查结束时调用, 以便把本轮的消息合并发送 """
+        self.__event.set()
+
+    def __run(self):
+        while True:
+            self.__event.wait(OUTBOX_POLL_INTERVAL)
+            self.__event.clear()
+            try:
+                if self.__should_drain is None or self.__should_drain():
+                    self.drain()
+            except Exception:
+                write_log_exception("Something wrong when posting messages to Telegram!")
+
+    def __get_bucket(self, chat_id):
+        bucket = self.__buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.__buckets[chat_id] = TokenBucket(*TG_RATE_LIMIT)
+        return bucket
+
+    def __send_batch(self, chat_id, text, rows):
+        self.__get_bucket(chat_id).acquire()
         try:
-            BOT.send_message(user, text, parse_mode="Markdown")
-        except:
-            traceback_string = traceback.format_exc()
-            print(traceback_string)
-            print("! Error: failed to post message to Telegram!")
-            write_log_warning(*traceback_string.splitlines())
-            write_log_warning("Failed to post message to Telegram!")
+            with METRICS.timer("telegram_send_seconds"):
+                send_message(text, chat_id)
+        except Exception as error:
+            METRICS.inc("telegram_send_total", result="error")
+            return error
+        METRICS.inc("telegram_send_total", result="ok")
+        ids = [row.ID for row in rows]
+        DB_WRITER.execute(
+            lambda session: session.query(OutboxMessage).filter(
+                OutboxMessage.ID.in_(ids)
+            ).delete(synchronize_session=False)
+        )
+        return None
+
+    def __record_failure(self, row, error):
+        attempts = row.ATTEMPTS + 1
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            write_log_warning(
+                "Failed to post message to Telegram! Message dropped: %s" % row.TEXT[:64],
+                chat_id=row.CHAT_ID, error=repr(error)
+            )
+            DB_WRITER.execute(
+                lambda session: session.query(OutboxMessage).filter(
+                    OutboxMessage.ID == row.ID
+                ).delete(synchronize_session=False)
+            )
+            return
+        delay = _get_retry_after(error) or min(30 * 2 ** attempts, 3600)
+        DB_WRITER.execute(
+            lambda session: session.query(OutboxMessage).filter(OutboxMessage.ID == row.ID).update(
+                {"ATTEMPTS": attempts, "NEXT_TRY_TIME": time.time() + delay},
+                synchronize_session=False
+            )
+        )
+
+    def drain(self):
+        """
+        发送所有已到重试时间的消息, 可以在没有启动后台线程时直接调用(如单次检查结束时)
+        :return: 发送成功的消息条数
+        """
+        with self.__drain_lock:
+            rows_by_chat = {}
+            for row in OutboxMessage.get_pending(time.time()):
+                rows_by_chat.setdefault(row.CHAT_ID, []).append(row)
+            sent_count = 0
+            for chat_id, rows in rows_by_chat.items():
+                for text, batch_rows in _merge_messages(rows):
+                    error = self.__send_batch(chat_id, text, batch_rows)
+                    if error is None:
+                        sent_count += len(batch_rows)
+                        continue
+                    retry_after = _get_retry_after(error)
+                    if retry_after:
+                        time.sleep(retry_after)
+                    # 合并后的消息发送失败时(如Markdown解析错误)逐条发送, 以隔离出错的消息
+                    for row in batch_rows:
+                        single_error = error
+                        if len(batch_rows) > 1:
+                            single_error = self.__send_batch(chat_id, row.TEXT[:MESSAGE_MAX_LENGTH], [row])
+                        if single_error is None:
+                            sent_count += 1
+                        else:
+                            self.__record_failure(row, single_error)
+            if sent_count:
+                write_log_info("Posted %d messages to Telegram" % sent_count)
+            return sent_count
+
+OUTBOX = Outbox()
+
+def post_message(text, user=TG_SENDTO):
+    """ 将消息放入发件箱, 在检查结果写入数据库之后由后台线程发送, 不会阻塞调用者 """
+    OUTBOX.put(text, user)